@@ -6,7 +6,7 @@ a group are present or otherwise accounted for
 import argparse
 import pandas as pd
 import sibispy
-from typing import List
+from typing import Dict, List
 from sibispy import cli
 import sys
 from pathlib import Path
@@ -56,6 +56,10 @@ FORM_GROUPS = {
 }
 
 
+# Inventory columns used by the form group checks
+STATUS_COLUMNS = ['study_id', 'redcap_event_name', 'status']
+
+
 def parse_args(input_args: List = None) -> argparse.Namespace:
     parser = argparse.ArgumentParser()
     parser.add_argument("-v", "--verbose", help="Verbose operation",
@@ -80,25 +84,44 @@ def parse_args(input_args: List = None) -> argparse.Namespace:
 
 
 def process_form_group(forms, inventory_dir, form_group_name: str = 'Check?'):
-    # 1. Rename the `status` column (missing/present/absent/excluded) created
-    #    in the inventory to the name of form, and only keep that column
-    # 2. Set index to id,event,form
-    # 3. Join on index, get anyplace where row.any() and not row.all()
-    data = {form: (pd.read_csv(inventory_dir / F"{form}.csv"))
+    data = {form: (pd.read_csv(inventory_dir / F"{form}.csv",
+                               usecols=STATUS_COLUMNS))
+            for form in forms}
+    return classify_form_group(get_form_statuses(data), forms,
+                               form_group_name)
+
+
+def get_form_statuses(inventories: Dict[str, pd.DataFrame],
+                      forms: List = None) -> Dict[str, pd.Series]:
+    """
+    Get the `status` column (PRESENT/MISSING/EXCLUDED/EMPTY) of inventories
+    that are already loaded (keyed by form name), named after the form and
+    indexed by study_id and redcap_event_name. The statuses can be shared by
+    all form groups that the forms belong to.
+    """
+    if forms is None:
+        forms = inventories.keys()
+    return {form: (inventories[form]
+                   .set_index(['study_id', 'redcap_event_name'])['status']
+                   .rename(form))
             for form in forms}
-    for form in forms:
-        data[form].rename(columns={'status': form}, inplace=True)
-        data[form] = (data[form]
-                      .set_index(['study_id', 'redcap_event_name'])
-                      .loc[:, [form]])
-        data[form]
-    all_data = pd.concat(data.values(), axis=1, sort=False)
-    all_data[form_group_name] = (all_data.apply(
-        lambda row: ((row == 'PRESENT').all()
-                     or ((row == 'PRESENT').any()
-                         and not (row == 'EMPTY').any())
-                     or not (row == 'PRESENT').any()),
-        axis=1))
+
+
+def classify_form_group(statuses: Dict[str, pd.Series], forms: List,
+                        form_group_name: str = 'Check?') -> pd.DataFrame:
+    """
+    Join the statuses of the forms of a group (see get_form_statuses) and add
+    the form_group_name column - False if one form of the group is PRESENT
+    while another one is EMPTY, True otherwise.
+    """
+    all_data = pd.concat([statuses[form] for form in forms], axis=1,
+                         sort=False)
+
+    # Number of present and empty forms of each row - a row is fine if all
+    # forms are present, if none is, or if no other form is empty
+    present_count = all_data.eq('PRESENT').sum(axis=1)
+    empty_count = all_data.eq('EMPTY').sum(axis=1)
+    all_data[form_group_name] = ~((present_count > 0) & (empty_count > 0))
 
     return all_data
 
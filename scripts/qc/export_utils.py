@@ -0,0 +1,96 @@
+"""
+Chunked export of REDCap records, shared by the QC scripts.
+"""
+
+import collections
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import List
+
+import pandas as pd
+import redcap as rc
+
+
+def export_records_in_chunks(project: rc.Project,
+                             records: List,
+                             chunk_size: int = 100,
+                             max_workers: int = 4,
+                             verbose: bool = False,
+                             **kwargs) -> pd.DataFrame:
+    """
+    Export records from REDCap in chunks of up to chunk_size records and
+    concatenate the chunks once, in the order of records. kwargs are passed on
+    to project.export_records (always with format='df').
+
+    Up to max_workers chunks are exported concurrently. A chunk that fails is
+    split in halves, which are exported again; every chunk exported after that
+    is twice as large as the previous one until it reaches chunk_size again.
+    Chunks without any data are skipped.
+
+    Returns None if no chunk has data. Raises ValueError if a single record
+    cannot be exported.
+    """
+    # Record lists exported by event repeat IDs - export each record once
+    records = list(dict.fromkeys(records))
+
+    retry_chunks = collections.deque()
+    next_start = 0
+    current_size = chunk_size
+    responses = {}
+
+    def export_chunk(start, end):
+        chunk_start_time = time.time()
+        try:
+            response = project.export_records(records=records[start:end],
+                                              format='df', **kwargs)
+        except pd.errors.EmptyDataError:
+            response = None
+        return response, time.time() - chunk_start_time
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        running = {}
+        while True:
+            while len(running) < max_workers:
+                if retry_chunks:
+                    (start, end) = retry_chunks.popleft()
+                elif next_start < len(records):
+                    (start, end) = (next_start,
+                                    min(next_start + current_size, len(records)))
+                    next_start = end
+                else:
+                    break
+                running[executor.submit(export_chunk, start, end)] = (start, end)
+
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                (start, end) = running.pop(future)
+                try:
+                    (responses[start], seconds) = future.result()
+                except (rc.RedcapError, IOError) as e:
+                    if end - start == 1:
+                        for other in running:
+                            other.cancel()
+                        raise ValueError("Chunked export failed for record {}: {}"
+                                         .format(records[start], e))
+
+                    middle = start + (end - start) // 2
+                    retry_chunks.extendleft([(middle, end), (start, middle)])
+                    current_size = max(1, (end - start) // 2)
+                    if verbose:
+                        print("Export of {} records failed, retrying in chunks of {}"
+                              .format(end - start, middle - start))
+                    continue
+
+                current_size = min(chunk_size, current_size * 2)
+                if verbose:
+                    print("Exported {} records in {:.2f}s"
+                          .format(end - start, seconds))
+
+    chunks = [responses[start] for start in sorted(responses)
+              if responses[start] is not None]
+    if not chunks:
+        return None
+    return pd.concat(chunks, axis=0)
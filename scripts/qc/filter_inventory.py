@@ -4,9 +4,15 @@ Quickly subset Redcap inventories.
 
 import argparse
 import pandas as pd
+import re
 import sys
+from pathlib import Path
+from typing import Dict, Iterator, List, Tuple
 # import sibispy
 
+from check_form_groups import (FORM_GROUPS, classify_form_group,
+                               get_form_statuses)
+
 # Reports
 
 ## 1. Reports that indicate mistakes (site check required)
@@ -94,6 +100,168 @@ def get_filter_results(inventorized_data, filter_function, verbose=False):
         return inventorized_data.loc[index]
 
 
+FILTER_LIST = [
+    empty_marked_present,
+    content_marked_missing,
+    less_content_than_max,
+    empty_unmarked,
+    content_unmarked,
+    content_not_complete,
+    missing_not_complete,
+    excluded_with_content,
+]
+FILTERS = {x.__name__: x for x in FILTER_LIST}
+
+# Filters, sites and form groups reported on in batch mode
+BATCH_FILTERS = [
+    'empty_marked_present',
+    'content_marked_missing',
+    'less_content_than_max',
+    'empty_unmarked',
+    'content_unmarked',
+    'content_not_complete',
+    'missing_not_complete',
+]
+BATCH_SITES = ['sri', 'duke', 'ohsu', 'upmc', 'ucsd']
+BATCH_FORM_GROUPS = ['deldisc', 'youth_report', 'np', 'mri', 'deldisc_stroop']
+
+
+def filter_inventories(inventories: List[Tuple[str, pd.DataFrame]],
+                       filter_function, output, verbose=False) -> bool:
+    """
+    Apply filter_function to each of the (filename, data) inventories and
+    write all matches to output. Nothing is written if there are none.
+
+    Returns True if matches were written.
+    """
+    filter_name = filter_function.__name__
+    all_out = []
+    for filename, data in inventories:
+        result = get_filter_results(data, filter_function, verbose=verbose)
+        if result is None:
+            if verbose:
+                print("Filter {} failed on file {}; skipping"
+                      .format(filter_name, filename))
+        elif not result.empty:
+            all_out.append(result)
+
+            if verbose:
+                if output == sys.stdout:
+                    output_display_name = "stdout"
+                else:
+                    output_display_name = output
+
+                print("Filter {} used on {} => {}"
+                      .format(filter_name, filename, output_display_name))
+        else:
+            if verbose:
+                print("Filter {} used on {} => no matches, skipping."
+                      .format(filter_name, filename))
+
+    if len(all_out) > 0:
+        (pd.concat(all_out, sort=False)
+         .to_csv(output, index=False, float_format="%.0f"))
+        return True
+    return False
+
+
+def load_event_inventories(inventory_dir: Path) \
+        -> Iterator[Tuple[str, List[Tuple[Path, pd.DataFrame]]]]:
+    """
+    Yield (event, [(file, data), ...]) for each event subdirectory of
+    inventory_dir, reading each form inventory of the event once.
+    """
+    for event_dir in sorted(inventory_dir.iterdir()):
+        if not event_dir.is_dir():
+            continue
+        yield (event_dir.name,
+               [(path, pd.read_csv(path))
+                for path in sorted(event_dir.glob('*.csv'))])
+
+
+def run_batch(inventory_dir: Path, report_dir: Path,
+              inventory_by_site_dir: Path, report_by_site_dir: Path,
+              verbose: bool = False):
+    """
+    Write all reports in a single process, reading each inventory once:
+
+    1. report_dir / event / filter / form.csv - matches of each filter in the
+       inventories of inventory_dir
+    2. report_by_site_dir / site / event / filter.csv - matches of each filter
+       in all inventories of a site and event
+    3. inventory_by_site_dir / site / event / form_groups{,_problem} /
+       group.csv - check_form_groups classification of full-year visits
+    """
+    filters = [FILTERS[name] for name in BATCH_FILTERS]
+
+    # 1. All sites, one report per event, filter and form
+    for event, inventories in load_event_inventories(inventory_dir):
+        for filter_function in filters:
+            filter_dir = report_dir / event / filter_function.__name__
+            filter_dir.mkdir(parents=True, exist_ok=True)
+            for path, data in inventories:
+                filter_inventories([(path, data)], filter_function,
+                                   filter_dir / path.name, verbose=verbose)
+
+    for site in BATCH_SITES:
+        site_dir = inventory_by_site_dir / site
+        if not site_dir.is_dir():
+            if verbose:
+                print("No inventories for site {}; skipping".format(site))
+            continue
+
+        for event, inventories in load_event_inventories(site_dir):
+            # 2. One report per site, event and filter, across all forms
+            site_report_dir = report_by_site_dir / site / event
+            site_report_dir.mkdir(parents=True, exist_ok=True)
+            for filter_function in filters:
+                filter_inventories(
+                    inventories, filter_function,
+                    site_report_dir / F"{filter_function.__name__}.csv",
+                    verbose=verbose)
+
+            # 3. Form groups - only for full-year visits
+            if re.match('.+month.+', event):
+                continue
+            write_form_group_reports({path.stem: data
+                                      for path, data in inventories},
+                                     site_dir / event, verbose=verbose)
+
+
+def write_form_group_reports(inventories: Dict[str, pd.DataFrame],
+                             event_dir: Path, verbose: bool = False):
+    """
+    Write the check_form_groups reports of BATCH_FORM_GROUPS for the
+    inventories of an event (keyed by form name) to the form_groups (full
+    classification) and form_groups_problem (failures only) subdirectories of
+    event_dir.
+    """
+    (event_dir / 'form_groups').mkdir(exist_ok=True)
+    (event_dir / 'form_groups_problem').mkdir(exist_ok=True)
+
+    # Statuses of each form are extracted once for all groups it belongs to
+    group_forms = {form for group in BATCH_FORM_GROUPS
+                   for form in FORM_GROUPS[group] if form in inventories}
+    statuses = get_form_statuses(inventories, group_forms)
+
+    for group in BATCH_FORM_GROUPS:
+        forms = FORM_GROUPS[group]
+        if not all(form in inventories for form in forms):
+            if verbose:
+                print("Data for form group {} not found in {}"
+                      .format(group, event_dir))
+            continue
+
+        report = classify_form_group(statuses, forms, group)
+        failures_only_df = report.loc[~report[group]]
+        if not failures_only_df.empty:
+            failures_only_df.to_csv(event_dir / 'form_groups_problem'
+                                    / F"{group}.csv")
+        elif verbose:
+            print(F"No failures for {group}!")
+        report.to_csv(event_dir / 'form_groups' / F"{group}.csv")
+
+
 def parse_args(filter_choices, input_args=None):
     parser = argparse.ArgumentParser()
     parser.add_argument("-v", "--verbose", help="Verbose operation",
@@ -103,64 +271,64 @@ def parse_args(filter_choices, input_args=None):
     #                     action="store_true")
     parser.add_argument("-i", "--input",
                         help="Inventory file to operate on",
-                        nargs='+',
-                        required=True)
+                        nargs='+')
     parser.add_argument('-o', '--output',
                         help="File to save filtered inventory to",
                         default=sys.stdout)
     # `choices` in `help` courtesy of https://stackoverflow.com/a/20335589
     parser.add_argument('filter', metavar='FILTER', choices=filter_choices,
+                        nargs='?',
                         help="Filter function to apply, one of following: "
                         "{%(choices)s}")
+    batch = parser.add_argument_group(
+        'batch mode',
+        "Write all filter and form group reports of an inventory tree (as "
+        "made by make_all_inventories.py) in a single run")
+    batch.add_argument('-b', '--batch',
+                       help="Run in batch mode instead of filtering --input",
+                       action="store_true")
+    batch.add_argument('--inventory-dir',
+                       help="Directory of per-event inventories",
+                       type=Path,
+                       default=Path('/fs/ncanda-share/log/make_all_inventories/inventory/'))
+    batch.add_argument('--report-dir',
+                       help="Directory to write per-event reports to",
+                       type=Path,
+                       default=Path('/fs/ncanda-share/log/make_all_inventories/report/'))
+    batch.add_argument('--inventory-by-site-dir',
+                       help="Directory of inventories split by site "
+                            "(default: inventory_by_site next to "
+                            "--inventory-dir)",
+                       type=Path)
+    batch.add_argument('--report-by-site-dir',
+                       help="Directory to write per-site reports to "
+                            "(default: report_by_site next to --report-dir)",
+                       type=Path)
     args = parser.parse_args(input_args)
+
+    if args.batch:
+        if args.inventory_by_site_dir is None:
+            args.inventory_by_site_dir = (args.inventory_dir / '..'
+                                          / 'inventory_by_site')
+        if args.report_by_site_dir is None:
+            args.report_by_site_dir = args.report_dir / '..' / 'report_by_site'
+    elif not args.input or not args.filter:
+        parser.error("--input and FILTER are required unless --batch is used")
     return args
 
 
 if __name__ == '__main__':
-    # TODO: There should be some way to auto-generate this - maybe embed the
-    # filters in a file, import it, then get the names of all callables?
-    FILTER_LIST = [
-        empty_marked_present,
-        content_marked_missing,
-        less_content_than_max,
-        empty_unmarked,
-        content_unmarked,
-        content_not_complete,
-        missing_not_complete,
-        excluded_with_content,
-    ]
-    FILTERS = {x.__name__: x for x in FILTER_LIST}
-
     args = parse_args(FILTERS.keys())
 
-    # TODO: Should explicitly assume + read in columns?
-    all_out = []
-    for filename in args.input:
-        data = pd.read_csv(filename)
-        filter_function = FILTERS[args.filter]
-        result = get_filter_results(data, filter_function,
-                                    verbose=args.verbose)
-        if result is None:
-            if args.verbose:
-                print("Filter {} failed on file {}; skipping"
-                      .format(args.filter, filename))
-        elif not result.empty:
-            all_out.append(result)
-
-            if args.verbose:
-                if args.output == sys.stdout:
-                    output_display_name = "stdout"
-                else:
-                    output_display_name = args.output
+    if args.batch:
+        run_batch(args.inventory_dir, args.report_dir,
+                  args.inventory_by_site_dir, args.report_by_site_dir,
+                  verbose=args.verbose)
+        sys.exit(0)
 
-                print("Filter {} used on {} => {}"
-                      .format(args.filter, filename, output_display_name))
-        else:
-            if args.verbose:
-                print("Filter {} used on {} => no matches, skipping."
-                      .format(args.filter, filename))
-
-    if len(all_out) > 0:
-        (pd.concat(all_out, sort=False)
-         .to_csv(args.output, index=False, float_format="%.0f"))
+    # TODO: Should explicitly assume + read in columns?
+    filter_inventories([(filename, pd.read_csv(filename))
+                        for filename in args.input],
+                       FILTERS[args.filter], args.output,
+                       verbose=args.verbose)
     sys.exit(0)
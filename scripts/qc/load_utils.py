@@ -1,36 +1,31 @@
 import pandas as pd
 import redcap as rc
+from export_utils import export_records_in_chunks
 
 # Taken from http://pycap.readthedocs.io/en/latest/deep.html#dealing-with-large-exports
 # and adapted to scope down to forms
-def chunked_export(project, form, chunk_size=100, verbose=True, export_data_access_groups=False, **kwargs):
-    def chunks(l, n):
-        """Yield successive n-sized chunks from list l"""
-        for i in range(0, len(l), n):
-            yield l[i:i+n]
+def chunked_export(project, form, chunk_size=100, verbose=True, export_data_access_groups=False,
+                   max_workers=4, **kwargs):
+    """
+    Export a form in chunks of up to chunk_size records (see
+    export_utils.export_records_in_chunks) - kwargs are passed on to
+    pandas.read_csv. Raises ValueError if the export fails.
+    """
     record_list = project.export_records(fields=[project.def_field])
     records = [r[project.def_field] for r in record_list]
-    try:
-        response = None
-        record_count = 0
-        for record_chunk in chunks(records, chunk_size):
-            record_count = record_count + chunk_size
-            chunked_response = project.export_records(
-                records=record_chunk,
-                fields=[project.def_field],
-                forms=[form],
-                format='df',
-                export_data_access_groups=export_data_access_groups,
-                df_kwargs={'low_memory': False}.update(kwargs))
-            if response is not None:
-                response = pd.concat([response, chunked_response], axis=0)
-            else:
-                response = chunked_response
-    except rc.RedcapError:
-        msg = "Chunked export failed for chunk_size={:d}".format(chunk_size)
-        raise ValueError(msg)
-    else:
-        return response
+    df_kwargs = {'low_memory': False}
+    df_kwargs.update(kwargs)
+    response = export_records_in_chunks(project, records,
+                                        chunk_size=chunk_size,
+                                        max_workers=max_workers,
+                                        verbose=verbose,
+                                        fields=[project.def_field],
+                                        forms=[form],
+                                        export_data_access_groups=export_data_access_groups,
+                                        df_kwargs=df_kwargs)
+    if response is None:
+        raise pd.errors.EmptyDataError("No records for form {}".format(form))
+    return response
 
 
 def load_all_forms(api, arm='1', export_data_access_groups=False):
@@ -57,40 +52,15 @@ def all_forms_exist_in_redcap(form_names, api):
 def load_form(api, form_name, verbose=True, export_data_access_groups=False):
     if verbose:
         print(form_name)
-    
+
+    # Chunks that fail are split up until single records - no need to start
+    # over with smaller chunks
     try:
         if verbose:
             print("Trying chunked export, 5000 records at a time")
-        return chunked_export(api, form_name, 5000,
-                              export_data_access_groups=export_data_access_groups)
-    except (ValueError, rc.RedcapError, pd.io.common.EmptyDataError):
-        pass
-    
-    # 2. Chunked load with chunk size of 1000
-    try:
-        if verbose:
-            print("Trying chunked export, 1000 records at a time")
-        return chunked_export(api, form_name, 1000,
-                              export_data_access_groups=export_data_access_groups)
-    except (ValueError, rc.RedcapError, pd.io.common.EmptyDataError):
-        pass
-    
-    # 2. Chunked load with default chunk size
-    try:
-        if verbose:
-            print("Trying chunked export, default chunk size (100)")
-        return chunked_export(api, form_name, 100,
-                              export_data_access_groups=export_data_access_groups)
-    except (ValueError, rc.RedcapError, pd.io.common.EmptyDataError):
-        pass
-    
-    # 3. Chunked load with tiny chunk
-    try:
-        if verbose:
-            print("Trying chunked export with tiny chunks (10)")
-        return chunked_export(api, form_name, 10,
+        return chunked_export(api, form_name, 5000, verbose=verbose,
                               export_data_access_groups=export_data_access_groups)
-    except (ValueError, rc.RedcapError, pd.io.common.EmptyDataError):
+    except (ValueError, rc.RedcapError, pd.errors.EmptyDataError):
         print("Giving up")
         return None
 
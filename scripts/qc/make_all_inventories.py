@@ -4,7 +4,7 @@ Use make_redcap_inventory to make all available inventories
 """
 
 import argparse
-from make_redcap_inventory import make_redcap_inventory
+from make_redcap_inventory import make_event_inventories
 import os
 from pathlib import Path
 import pdb
@@ -44,8 +44,8 @@ def main(args):
     # 1. export_fem to get event-form connections
     # 2. Optional: filter through the FEM based on CLI args
     # 3. for each event, create all needed subdirectories
-    # 4. for each event/form, call make_redcap_inventory and write out full
-    #    report to created subdir
+    # 4. for each form, export it once for all its events, then write out
+    #    the full report of each event to created subdir
     # 5. optionally, if --split-by-dag is called, split the received inventory
     #    by DAG
     args = parse_args()
@@ -87,61 +87,71 @@ def main(args):
         output_by_dag_dir = Path(args.output_dag_dir)
         __check_dir(output_by_dag_dir)
 
-    # create directory for event
-    for _, row in fem.iterrows():
-        form = row['form']
-        event = row['unique_event_name']
-        if args.verbose:
-            print(F"{form} / {event}: Beginning inventory")
-        inventory = make_redcap_inventory(api=api,
-                                          forms=[form],
-                                          events=[event],
-                                          post_to_github=args.post_to_github,
-                                          include_dag=True,
-                                          verbose=args.verbose)
-        if inventory.empty:
-            if args.verbose:
-                print("\tNothing to inventorize!")
-            continue
-
-        target_dir = output_dir / event
-        target_dir.mkdir(mode=0o775, exist_ok=True)
-
-        target_path = target_dir / F"{form}.csv"
+    # Record IDs are exported once for all forms
+    records = [r[api.def_field]
+               for r in api.export_records(fields=[api.def_field])]
+
+    # Each form is exported once across all of its events, then split by
+    # event (and DAG) in memory
+    for form, form_events in fem.groupby('form', sort=False):
+        events = form_events['unique_event_name'].tolist()
         if args.verbose:
-            print(F"\tWriting inventory to {target_path}...")
-        inventory.to_csv(target_path)
-
-        # split by DAG:
-
-        # 1. extract available DAGs from inventory, if any
-        # 2. iterating over DAGs, subset the inventory dataframe
-        # 3. if needed, create DAG subdir: output_by_dag_dir / dag / event
-        # 4. if non-empty, save to output_by_dag_dir / dag / event / form
-        if output_by_dag_dir:
-            all_dags = (inventory['dag']
-                        .drop_duplicates().tolist())
-            if args.verbose:
-                print(F"{form} / {event}: Subdividing by DAG, available DAGs: "
-                      F"{all_dags}")
-
-            for dag in all_dags:
-                # TODO: Should really extract this logic into a separate code,
-                # since it's an almost exact replica of the logic that's saving
-                # the full inventory above
-                dag = str(dag)
-                target_dag_dir = output_by_dag_dir / dag / event
-                target_dag_dir.mkdir(mode=0o775, parents=True, exist_ok=True)
-
-                target_dag_path = target_dag_dir / F"{form}.csv"
-                (inventory.loc[inventory['dag'] == dag]
-                 .to_csv(target_dag_path))
+            print(F"{form}: Beginning inventory of events {events}")
+        inventories = make_event_inventories(api=api,
+                                             form=form,
+                                             events=events,
+                                             records=records,
+                                             include_dag=True,
+                                             verbose=args.verbose)
+
+        for event in events:
+            if event not in inventories:
                 if args.verbose:
-                    print(F"\tWriting {dag}-specific inventory to "
-                          F"{target_dag_path}...")
+                    print(F"{form} / {event}: Nothing to inventorize!")
+                continue
+
+            __write_inventory(inventories[event], form, event, output_dir,
+                              output_by_dag_dir, args.verbose)
+
     return 0
 
 
+def __write_inventory(inventory, form: str, event: str, output_dir: Path,
+                      output_by_dag_dir: Path = None, verbose: bool = False):
+    target_dir = output_dir / event
+    target_dir.mkdir(mode=0o775, exist_ok=True)
+
+    target_path = target_dir / F"{form}.csv"
+    if verbose:
+        print(F"\tWriting inventory to {target_path}...")
+    inventory.to_csv(target_path)
+
+    # split by DAG:
+
+    # 1. extract available DAGs from inventory, if any
+    # 2. iterating over DAGs, subset the inventory dataframe
+    # 3. if needed, create DAG subdir: output_by_dag_dir / dag / event
+    # 4. if non-empty, save to output_by_dag_dir / dag / event / form
+    if output_by_dag_dir:
+        all_dags = (inventory['dag']
+                    .drop_duplicates().tolist())
+        if verbose:
+            print(F"{form} / {event}: Subdividing by DAG, available DAGs: "
+                  F"{all_dags}")
+
+        for dag in all_dags:
+            dag = str(dag)
+            target_dag_dir = output_by_dag_dir / dag / event
+            target_dag_dir.mkdir(mode=0o775, parents=True, exist_ok=True)
+
+            target_dag_path = target_dag_dir / F"{form}.csv"
+            (inventory.loc[inventory['dag'] == dag]
+             .to_csv(target_dag_path))
+            if verbose:
+                print(F"\tWriting {dag}-specific inventory to "
+                      F"{target_dag_path}...")
+
+
 def __check_dir(dirpath: Path):
     try:
         dirpath.mkdir(mode=0o775, parents=True, exist_ok=True)
@@ -4,6 +4,7 @@ Given an API, load all the forms, count up their non-NA values, and mark their m
 """
 
 import argparse
+import io
 import pandas as pd
 import pdb
 import redcap as rc
@@ -63,25 +64,75 @@ def make_redcap_inventory(api: rc.Project,
 
     final_dfs = []
     for form in all_forms:
-        try:
-            form_stats = data[form].apply(get_flag_and_meta, axis=1)
-        except ValueError:
-            continue
-        form_stats['form_name'] = form
-        form_stats['status'] = make_classification(form_stats)
-        final_dfs.append(form_stats)
+        form_stats = get_form_inventory(form, data[form])
+        if form_stats is not None:
+            final_dfs.append(form_stats)
 
     return pd.concat(final_dfs, sort=False)
 
 
-# Apply to DF to get all empty records
-def get_flag_and_meta(row: pd.Series, verbose: bool = True) -> pd.Series:
+def make_event_inventories(api: rc.Project,
+                           form: str,
+                           events: List,
+                           records: List = None,
+                           include_dag: bool = False,
+                           verbose: bool = False) -> dict:
+    """
+    Make the inventories of a form for each of the events with a single export
+    of the form across all of them.
+
+    Returns a dict of inventories by event - each the same as
+    make_redcap_inventory would make for the form and event alone.
+    """
+    # Values are kept as text, so that each event's data types are inferred
+    # from that event's values only, as for an export of the event alone
+    data = chunked_form_export(api, forms=[form], events=events,
+                               include_dag=include_dag,
+                               fields=['visit_ignore'],
+                               records=records,
+                               df_kwargs={'dtype': str,
+                                          'keep_default_na': False})
+
+    inventories = {}
+    if data is None:
+        return inventories
+
+    data_events = data.index.get_level_values('redcap_event_name')
+    for event in events:
+        event_data = data.loc[data_events == event]
+        if event_data.empty:
+            continue
+        event_data = pd.read_csv(io.StringIO(event_data.to_csv()),
+                                 index_col=list(range(data.index.nlevels)),
+                                 low_memory=False)
+        form_stats = get_form_inventory(form, event_data)
+        if form_stats is not None:
+            inventories[event] = form_stats
+
+    return inventories
+
+
+def get_form_inventory(form: str, form_data: pd.DataFrame) -> pd.DataFrame:
+    """
+    Inventory of the exported records of a form - None if there is nothing to
+    inventorize
+    """
+    if form_data is None or form_data.empty:
+        return None
     try:
-        columns = row.columns.tolist()
-    except Exception as e:
-        # No columns in a Series
-        columns = row.index.tolist()
+        form_stats = get_form_stats(form_data)
+    except ValueError:
+        return None
+    form_stats['form_name'] = form
+    form_stats['status'] = make_classification(form_stats)
+    return form_stats
 
+
+def get_column_roles(columns: List) -> dict:
+    """
+    Sort the columns of a form into DAG, completion, exclusion, missingness and
+    checklist columns, and list all of those that are not form content ('meta')
+    """
     cols_dag = get_items_matching_regex('redcap_data_access_group', columns)
     cols_complete = get_items_matching_regex(
         "_complete$|^np_reyo_qc___completed$", columns)
@@ -108,17 +159,68 @@ def get_flag_and_meta(row: pd.Series, verbose: bool = True) -> pd.Series:
     all_meta_cols = (cols_complete + cols_ignore + cols_missing + cols_dag
                      + cols_missing_explanation + cols_checklists)
 
-    result = {}
-    if len(cols_dag) > 0:
-        result.update({'dag': row['redcap_data_access_group']})
+    return {'dag': cols_dag,
+            'complete': cols_complete,
+            'ignore': cols_ignore,
+            'missing': cols_missing,
+            'checklists_pure': cols_checklists_pure,
+            'meta': all_meta_cols}
+
 
-    non_nan_count = row.drop(all_meta_cols).notnull().sum()
-    result.update({'non_nan_count': non_nan_count})
+def get_float_columns(form_data: pd.DataFrame) -> pd.Series:
+    """
+    Flag the columns whose values are floats when taken row by row: all of them
+    if the rows are floats (all columns numeric, some float), otherwise those
+    of float dtype
+    """
+    kinds = form_data.dtypes.map(lambda dtype: getattr(dtype, 'kind', 'O'))
+    if kinds.isin(['i', 'u', 'f']).all() and (kinds == 'f').any():
+        return pd.Series(True, index=form_data.columns)
+    return kinds == 'f'
+
+
+def get_max_with_type(form_data: pd.DataFrame, columns: List,
+                      float_columns: pd.Series):
+    """
+    Row-wise maximum of columns (skipping NaN), and whether it is a float - as
+    for row-wise max, the first column holding the maximum decides
+    """
+    subset = form_data[columns]
+    maximum = subset.max(axis=1, skipna=True)
+    first_max = subset.eq(maximum, axis=0).values.argmax(axis=1)
+    is_float = pd.Series(float_columns[columns].values[first_max],
+                         index=form_data.index) | maximum.isna()
+    return maximum, is_float
+
+
+def get_form_stats(form_data: pd.DataFrame) -> pd.DataFrame:
+    """
+    For each record of a form, count its non-NaN values and get its DAG,
+    exclusion, missingness and completion status.
+
+    Column roles are resolved once per form and all counts are whole-frame
+    operations. The resulting columns have the data types that applying the
+    former row-by-row computation would give them, so that inventories are
+    written exactly as before.
+    """
+    roles = get_column_roles(form_data.columns.tolist())
+    float_columns = get_float_columns(form_data)
+
+    stats = {}
+    is_float = {}
+    if len(roles['dag']) > 0:
+        stats['dag'] = form_data['redcap_data_access_group']
+        is_float['dag'] = stats['dag'].isna()
+
+    non_nan_count = (form_data.drop(columns=roles['meta'])
+                     .notnull().sum(axis=1))
 
     # Count checklists properly
-    if cols_checklists_pure:
-        col_val1_count = (row[cols_checklists_pure].isin([1, '1'])).sum()
-        result.update({'non_nan_count': non_nan_count + col_val1_count})
+    if roles['checklists_pure']:
+        non_nan_count = non_nan_count + (form_data[roles['checklists_pure']]
+                                         .isin([1, '1']).sum(axis=1))
+    stats['non_nan_count'] = non_nan_count
+    is_float['non_nan_count'] = pd.Series(False, index=form_data.index)
 
     # There *can* be multiple sort-of exclusion/missingness columns (for one,
     # we're including visit_ignore___yes on all forms, and some have their own
@@ -126,22 +228,45 @@ def get_flag_and_meta(row: pd.Series, verbose: bool = True) -> pd.Series:
     # one 1 flipped for exclusion, the form is excluded. Same with missingness.
     #
     # Taking the max of multiple columns is just a quick way to do that.
-    if cols_ignore:
-        result.update({'exclude': row[cols_ignore].max(skipna=True)})
-    if cols_missing:
-        result.update({'missing': row[cols_missing].max(skipna=True)})
-    if len(cols_complete) > 0:
-        if 'np_reyo_qc___completed' in cols_complete:
+    if roles['ignore']:
+        stats['exclude'], is_float['exclude'] = get_max_with_type(
+            form_data, roles['ignore'], float_columns)
+    if roles['missing']:
+        stats['missing'], is_float['missing'] = get_max_with_type(
+            form_data, roles['missing'], float_columns)
+    if len(roles['complete']) > 0:
+        if 'np_reyo_qc___completed' in roles['complete']:
             # special case: for Reyo QC, the checklist is a completion status,
             # so we should consider it, but the form should also be marked
             # Complete
-            result.update({'complete': row[cols_complete].max(skipna=True)})
+            stats['complete'], is_float['complete'] = get_max_with_type(
+                form_data, roles['complete'], float_columns)
         else:
             # take the last completion status, on the assumption that it's the
             # overall completion (currently not implementing LSSAGA subparts)
-            result.update({'complete': row[cols_complete[-1]]})
+            complete_col = roles['complete'][-1]
+            stats['complete'] = form_data[complete_col]
+            is_float['complete'] = (form_data[complete_col].isna()
+                                    | float_columns[complete_col])
+
+    stats = pd.DataFrame(stats, index=form_data.index)
+    is_float = pd.DataFrame(is_float, index=form_data.index)
+
+    # Records without a DAG have all their numbers turned into floats by any
+    # float among them - a numeric column is float if any record has a float
+    if 'dag' in stats:
+        promoted = stats['dag'].isna() & is_float.any(axis=1)
+    else:
+        promoted = is_float.any(axis=1)
+    for column in stats.columns:
+        if column == 'dag':
+            continue
+        if (is_float[column] | promoted).any():
+            stats[column] = stats[column].astype(float)
+        else:
+            stats[column] = stats[column].astype('int64')
 
-    return pd.Series(result)
+    return stats
 
 
 def make_classification(form: pd.DataFrame) -> pd.Series:
@@ -1,5 +1,6 @@
 import pandas as pd
 import redcap as rc
+from export_utils import export_records_in_chunks
 
 
 """
@@ -112,50 +113,44 @@ def form_has_content_and_is_not_missing(row):
 
 # Taken from http://pycap.readthedocs.io/en/latest/deep.html#dealing-with-large-exports
 # and adapted to scope down to forms
+def chunked_form_export(project, forms, events=None, include_dag=False, chunk_size=100, fields=[],
+                        records=None, df_kwargs=None, max_workers=4, verbose=False):
+    """
+    records: IDs of the records to export - all records of the project by
+    default. df_kwargs: arguments passed on to pandas.read_csv for each chunk.
+    See export_utils.export_records_in_chunks for how chunks are exported.
 
-# FIXME: Possibly duplicates chunk edges? Need to check it out
-def chunked_form_export(project, forms, events=None, include_dag=False, chunk_size=100, fields=[]):
+    Returns None if there are no records.
+    """
     if isinstance(forms, str):
         forms = [forms]
     if isinstance(events, str):
         events = [events]
-        
-    def chunks(l, n):
-        """Yield successive n-sized chunks from list l"""
-        for i in range(0, len(l), n):
-            yield l[i:i+n]
-    record_list = project.export_records(fields=[project.def_field])
-    records = [r[project.def_field] for r in record_list]
-    try:
-        response = None
-        record_count = 0
-        for record_chunk in chunks(records, chunk_size):
-            record_count = record_count + chunk_size
-            #print record_count
-            try:
-                chunked_response = project.export_records(records=record_chunk,
-                                                          fields=[project.def_field] + fields,
-                                                          forms=forms,
-                                                          events=events,
-                                                          export_data_access_groups=include_dag,
-                                                          format='df',
-                                                          df_kwargs={'low_memory': False})
-            except pd.errors.EmptyDataError:
-                print("Empty DataFrame error for event {}, fields {}, forms {}"
-                        .format(events, fields, forms))
-                continue
-
-            if response is not None:
-                response = pd.concat([response, chunked_response], axis=0)
-            else:
-                response = chunked_response
-    except rc.RedcapError:
-        msg = "Chunked export failed for chunk_size={:d}".format(chunk_size)
-        raise ValueError(msg)
+
+    if records is None:
+        record_list = project.export_records(fields=[project.def_field])
+        records = [r[project.def_field] for r in record_list]
+    if df_kwargs is None:
+        df_kwargs = {'low_memory': False}
+
+    response = export_records_in_chunks(project, records,
+                                        chunk_size=chunk_size,
+                                        max_workers=max_workers,
+                                        verbose=verbose,
+                                        fields=[project.def_field] + fields,
+                                        forms=forms,
+                                        events=events,
+                                        export_data_access_groups=include_dag,
+                                        df_kwargs=df_kwargs)
+    if response is None:
+        if verbose:
+            print("No records for events {}, fields {}, forms {}"
+                  .format(events, fields, forms))
+        return None
+
+    if project.is_longitudinal:
+        response.set_index([project.def_field, 'redcap_event_name'], inplace=True)
     else:
-        if project.is_longitudinal:
-            response.set_index([project.def_field, 'redcap_event_name'], inplace=True)
-        else:
-            response.set_index([project.def_field], inplace=True)
-            
-        return response
+        response.set_index([project.def_field], inplace=True)
+
+    return response
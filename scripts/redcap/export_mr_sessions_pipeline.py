@@ -9,14 +9,21 @@ from __future__ import print_function
 from builtins import str
 import re
 import os
+import io
+import gzip
 import glob
+import json
+import fnmatch
 import shutil
+import hashlib
 import sys
+import stat
 import tempfile 
 from sibispy import sibislogger as slog
 from sibispy import utils as sutils
 
 from export_mr_sessions_spiral import export_spiral_files
+from pipeline_file_transfers import FileTransfers
 
 #
 # Checker whether an EID file exists and has the same experiment ID and (if applicable) scan number stored in it.
@@ -36,6 +43,90 @@ def check_eid_file( eid_file_path, session_and_scan_string ):
     return False
 
 
+#
+# Pipeline file pattern (of the image XML files) and EID file of a series
+#
+def get_series_file_paths( to_directory, filename_pattern ):
+    # Put together target directory and filename pattern
+    to_path_pattern = os.path.join( to_directory, filename_pattern )
+
+    # If filename is a pattern with substitution, check whether entire directory exists
+    if '%' in filename_pattern:
+        pipeline_file_pattern = re.sub('%T%N','*',re.sub( '%n', '*', to_path_pattern)) + ".xml"
+        eid_file_path = os.path.join( to_directory, 'eid' )
+    else:
+        pipeline_file_pattern = to_path_pattern + ".xml"
+        eid_file_path = re.sub( '\.[^/]*', '.eid', to_path_pattern )
+
+    return (pipeline_file_pattern, eid_file_path)
+
+#
+# The manifest of a series lists its files with size and checksum - it sits
+# next to the EID file (e.g., t1.manifest for t1.eid)
+#
+def get_manifest_path( eid_file_path ):
+    return re.sub( 'eid$', 'manifest', eid_file_path )
+
+#
+# Checker whether the last publishing of a series was completed and its files
+# in to_directory still match the manifest (see get_manifest_mismatches).
+# Series exported before manifests were written have none and count as complete.
+#
+def check_manifest_complete( manifest_path, to_directory ):
+    if not os.path.exists( manifest_path ):
+        return True
+
+    try:
+        manifest_mtime = os.path.getmtime( manifest_path )
+        with open( manifest_path, 'r' ) as manifest_file:
+            manifest = json.load( manifest_file )
+    except:
+        return False
+
+    if not manifest.get( 'complete', False ):
+        return False
+
+    return not get_manifest_mismatches( manifest, to_directory, manifest_mtime )
+
+#
+# Compare the files of a series in to_directory with its manifest. Sizes are
+# always compared; checksums are compared for all files, or - if manifest_mtime
+# is given - only for files modified after the manifest was written, so that
+# checking an unchanged series does not read its images.
+#
+# Returns - names of the files that are missing or differ from the manifest
+#
+def get_manifest_mismatches( manifest, to_directory, manifest_mtime=None ):
+    mismatches = []
+    for name in sorted( manifest['files'].keys() ):
+        entry = manifest['files'][name]
+        file_path = os.path.join( to_directory, name )
+        try:
+            file_stat = os.stat( file_path )
+        except OSError:
+            mismatches.append( name )
+            continue
+
+        if file_stat.st_size != entry['size']:
+            mismatches.append( name )
+        elif ( manifest_mtime is None or file_stat.st_mtime > manifest_mtime ) and get_file_checksum( file_path ) != entry['sha256']:
+            mismatches.append( name )
+
+    return mismatches
+
+def write_manifest( manifest_path, manifest ):
+    tmp_path = manifest_path + '.tmp'
+    with open( tmp_path, 'w' ) as manifest_file:
+        json.dump( manifest, manifest_file, indent=1, sort_keys=True )
+    os.replace( tmp_path, manifest_path )
+
+def get_file_checksum( file_path ):
+    checksum = hashlib.sha256()
+    with open( file_path, 'rb' ) as fi:
+        for chunk in iter( lambda: fi.read( 1 << 20 ), b'' ):
+            checksum.update( chunk )
+    return checksum.hexdigest()
+
 #
 # Checker whether date of file is newer than in xnat 
 #
@@ -54,30 +145,89 @@ def check_file_date(pipeline_file,xnat_file):
 
 
 #
-# Export one series to pipeline tree, unless it already exists there
+# XNAT scan catalogs and archive directory listings, cached for the run - see
+# get_scan_catalog_text and cached_glob
 #
-# Returns - True if new files were created, False if not
+scan_catalog_cache = dict()
+listdir_cache = dict()
+exists_cache = dict()
+
 #
+# Get the part of the XNAT XML of a scan that lists its files (incl. the
+# catalog path). The XML of all scans of an experiment is fetched with a
+# single request the first time one of its scans is needed.
+#
+def get_scan_catalog_text( xnat, session, scan ):
+    if session not in scan_catalog_cache:
+        scan_catalog_cache[session] = dict()
+        try:
+            experiment_xml = xnat.raw_text( xnat.select.experiments[ session ] )
+            for match in re.finditer( '<xnat:scan\\s[^>]*?\\bID="([^"]*)".*?</xnat:scan>', experiment_xml, re.DOTALL ):
+                scan_catalog_cache[session][match.group(1)] = match.group(0)
+        except Exception:
+            # Scans are then fetched one by one
+            pass
+
+    if scan not in scan_catalog_cache[session]:
+        scan_catalog_cache[session][scan] = xnat.raw_text( xnat.select.experiments[ session ].scans[ scan ] )
+
+    return scan_catalog_cache[session][scan]
+
+def cached_exists( path ):
+    if path not in exists_cache:
+        exists_cache[path] = os.path.exists( path )
+    return exists_cache[path]
 
-def export_series( redcap_visit_id, xnat, redcap_key, session_and_scan_list, to_directory, filename_pattern, xnat_dir, verbose=False, timer_label=None):
+def cached_listdir( path ):
+    if path not in listdir_cache:
+        try:
+            listdir_cache[path] = os.listdir( path )
+        except OSError:
+            listdir_cache[path] = []
+    return listdir_cache[path]
+
+#
+# glob.glob for the XNAT archive that lists each directory only once per run
+#
+def cached_glob( pattern ):
+    if not glob.has_magic( pattern ):
+        if cached_exists( pattern ):
+            return [ pattern ]
+        return []
+
+    (dirname, basename) = os.path.split( pattern )
+    if glob.has_magic( dirname ):
+        dirs = cached_glob( dirname )
+    else:
+        dirs = [ dirname ]
+
+    matches = []
+    for directory in dirs:
+        names = fnmatch.filter( cached_listdir( directory ), basename )
+        if not basename.startswith( '.' ):
+            names = [ name for name in names if not name.startswith( '.' ) ]
+        matches += [ os.path.join( directory, name ) for name in names ]
+
+    return matches
+
+#
+# Export one series to pipeline tree, unless it already exists there. With an
+# export_queue, the conversion is queued rather than run right away.
+#
+# Returns - True if new files were created, False if not (or if queued)
+#
+
+def export_series( redcap_visit_id, xnat, redcap_key, session_and_scan_list, to_directory, filename_pattern, xnat_dir, verbose=False, timer_label=None, export_queue=None):
     (subject_label, event_label) = redcap_key
     # List should have at least one "SESSION/SCAN" entry
     if not '/' in session_and_scan_list:
         return False
 
-    # Put together target directory and filename pattern
     to_path_pattern = os.path.join( to_directory, filename_pattern )
+    (pipeline_file_pattern, eid_file_path) = get_series_file_paths( to_directory, filename_pattern )
 
-    # If filename is a pattern with substitution, check whether entire directory exists
-    if '%' in filename_pattern:
-        pipeline_file_pattern = re.sub('%T%N','*',re.sub( '%n', '*', to_path_pattern)) + ".xml"
-        eid_file_path = os.path.join( to_directory, 'eid' )
-    else:
-        pipeline_file_pattern = to_path_pattern + ".xml"
-        eid_file_path = re.sub( '\.[^/]*', '.eid', to_path_pattern )
-
-    # Check if EID is still the same 
-    eid_unchanged_flag = check_eid_file( eid_file_path, session_and_scan_list )
+    # Check if EID is still the same - and the series was completely published
+    eid_unchanged_flag = check_eid_file( eid_file_path, session_and_scan_list ) and check_manifest_complete( get_manifest_path( eid_file_path ), to_directory )
     
     # Check if files are already created 
     pipeline_file_list= glob.glob(pipeline_file_pattern)
@@ -86,10 +236,10 @@ def export_series( redcap_visit_id, xnat, redcap_key, session_and_scan_list, to_
     CreateDicomFlag=False
     for session_and_scan in session_and_scan_list.split( ' ' ):
         [ session, scan ] = session_and_scan.split( '/' )
-        match = re.match( '.*(' + xnat_dir +'/.*)scan_.*_catalog.xml.*', xnat.raw_text(xnat.select.experiments[ session ].scans[ scan ]), re.DOTALL )
+        match = re.match( '.*(' + xnat_dir +'/.*)scan_.*_catalog.xml.*', get_scan_catalog_text( xnat, session, scan ), re.DOTALL )
         if match:
             dicom_path = match.group(1)
-            if not os.path.exists( dicom_path ):
+            if not cached_exists( dicom_path ):
                 dicom_path = re.sub( 'storage/XNAT', 'ncanda-xnat', dicom_path )
             dicom_path_list.append( dicom_path )
 
@@ -97,7 +247,7 @@ def export_series( redcap_visit_id, xnat, redcap_key, session_and_scan_list, to_
             if eid_unchanged_flag and len(pipeline_file_list) : 
                 # Look for xnat file 
                 xnat_file_pattern = re.sub('/DICOM/','_*/image*.nii.xml',re.sub( '/SCANS/', '/RESOURCES/nifti/', dicom_path))
-                xnat_file_search  = glob.glob(xnat_file_pattern)
+                xnat_file_search  = cached_glob(xnat_file_pattern)
 
                 # If date of xnat file is newer than in pipeline then update  
                 if  xnat_file_search != [] and not check_file_date(pipeline_file_list[0],xnat_file_search[0]):
@@ -109,143 +259,347 @@ def export_series( redcap_visit_id, xnat, redcap_key, session_and_scan_list, to_
         return False
 
 
+    # Existing files are replaced once the new ones are complete - see publish_series
     if len(pipeline_file_list)  :
         [ session, scan ] = session_and_scan_list.split( ' ' )[0].split('/')
         slog.info(redcap_visit_id  + "_" + scan,"Warning: existing MR images of the pipeline are updated",
                       file = to_path_pattern,
                       experiment_xnat_id=session,
                       session_scan_list = session_and_scan_list )
-        # Remove existing files of that type to make sure we start with clean slate
-        for xml_file in pipeline_file_list:
-            os.remove(xml_file)
-            nii_file = re.sub('.nii.xml','.nii',xml_file)
-            if os.path.exists(nii_file):
-                os.remove(nii_file)
-            nii_file += ".gz"
-            if os.path.exists(nii_file):
-                os.remove(nii_file)
 
     if len( dicom_path_list ):
-        temp_dir = tempfile.mkdtemp()
-        # to_path_pattern = os.path.join( to_directory, filename_pattern )
-        tmp_path_pattern = os.path.join(temp_dir, filename_pattern )
-        if timer_label :
-            slog.startTimer2() 
-
-        args= '--tolerance 1e-3 --write-single-slices --no-progress -rxO %s %s 2>&1' % ( tmp_path_pattern, ' '.join( dicom_path_list ))
-        (ecode, sout, eout) = sutils.dcm2image(args)
-        if ecode :
-            slog.info(redcap_visit_id + "_" + scan,"Error: Unable to create dicom file",
-                      experiment_site_id=session,
-                      cmd=sutils.dcm2image_cmd + " " + args,
-                      err_msg = str(eout))
-            shutil.rmtree(temp_dir)
+        if export_queue:
+            export_queue.enqueue_conversion( redcap_visit_id, session, scan, session_and_scan_list, dicom_path_list, to_directory, filename_pattern, eid_file_path )
             return False
 
-        if timer_label:
-            slog.takeTimer2('convert_dicom_to_nifti', timer_label) 
+        return convert_series( redcap_visit_id, session, scan, session_and_scan_list, dicom_path_list, to_directory, filename_pattern, eid_file_path, timer_label=timer_label )
 
-        try:
-            if not os.path.exists(to_directory):
-                os.makedirs(to_directory)
-
-            open( eid_file_path, 'w' ).writelines( session_and_scan_list )
-        except:
-            error = "ERROR: unable to write EID file"
-            slog.info(redcap_visit_id + "_" + scan,error,
-                      experiment_site_id=session,
-                      eid_file_path = eid_file_path)
-
-        try: 
-            for f in os.listdir(temp_dir):
-                shutil.move(os.path.join(temp_dir,f),to_directory)
-
-        except Exception as err_msg: 
-            error = "ERROR: unable to move files"
-            slog.info(redcap_visit_id + "_" + scan,error,
-                      experiment_site_id = session,
-                      src_dir = temp_dir ,
-                      dest_dir = to_directory,
-                      err_msg = str(err_msg))
-            shutil.rmtree(temp_dir)
-            return False
+    return False
 
+#
+# Convert the DICOM files of a series into the pipeline tree - session and scan
+# are used to label error messages
+#
+# Returns - True if new files were created, False if not
+#
+def convert_series( redcap_visit_id, session, scan, session_and_scan_list, dicom_path_list, to_directory, filename_pattern, eid_file_path, timer_label=None ):
+    # Stage files next to the target directory, so that they can be renamed into it
+    try:
+        staging_parent = os.path.dirname( os.path.normpath( to_directory ) )
+        if not os.path.exists( staging_parent ):
+            os.makedirs( staging_parent )
+        temp_dir = tempfile.mkdtemp( prefix='.' + os.path.basename( os.path.normpath( to_directory ) ) + '-staging-', dir=staging_parent )
+    except Exception as err_msg:
+        slog.info(redcap_visit_id + "_" + scan,"ERROR: unable to create staging directory",
+                  experiment_site_id = session,
+                  dest_dir = to_directory,
+                  err_msg = str(err_msg))
+        return False
+
+    # to_path_pattern = os.path.join( to_directory, filename_pattern )
+    tmp_path_pattern = os.path.join(temp_dir, filename_pattern )
+    if timer_label :
+        slog.startTimer2() 
+
+    # Verbose, so that the output lists the images written - see publish_series
+    args= '--tolerance 1e-3 --write-single-slices --no-progress -rvxO %s %s 2>&1' % ( tmp_path_pattern, ' '.join( dicom_path_list ))
+    (ecode, sout, eout) = sutils.dcm2image(args)
+    if ecode :
+        slog.info(redcap_visit_id + "_" + scan,"Error: Unable to create dicom file",
+                  experiment_site_id=session,
+                  cmd=sutils.dcm2image_cmd + " " + args,
+                  err_msg = str(eout))
         shutil.rmtree(temp_dir)
-        return True
-    return False
+        return False
+
+    if timer_label:
+        slog.takeTimer2('convert_dicom_to_nifti', timer_label) 
+
+    if isinstance( sout, bytes ):
+        sout = sout.decode( 'utf-8', errors='replace' )
+
+    try:
+        return publish_series( redcap_visit_id, session, scan, session_and_scan_list, temp_dir, to_directory, filename_pattern, eid_file_path, converter_log=sout )
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
 
 #
-# Copy ADNI phantom T1w image file for structural session
+# Names of the images in staging_dir that the (verbose) output of dcm2image
+# reports as written
 #
-# Returns - True if new file as created, False if not
+def get_converter_images( converter_log, staging_dir ):
+    pattern = re.escape( os.path.join( staging_dir, '' ) ) + '([^\\s/:;,\'"]+\\.nii(\\.gz)?)'
+    return sorted( set( match.group(1) for match in re.finditer( pattern, converter_log ) ) )
+
+#
+# Publish the converted files of a series from the staging directory into the
+# pipeline tree. The files are checked to be complete - every image has the XML
+# file written by dcm2image, and the images are those listed in the output of
+# dcm2image (converter_log) - and listed with size and checksum in the
+# manifest of the series.
 #
-def copy_adni_phantom_t1w( redcap_visit_id, xnat, xnat_eid, to_directory ):
-    # Check if target file already exists
-    phantom_path = os.path.join( to_directory, 'phantom_t1.nii.gz' )
-    if os.path.exists( phantom_path ):
+# A series that has a directory of its own (filename pattern with '%') is
+# published by renaming the complete staging directory - including EID file,
+# manifest and any other files of the current directory - into place (see
+# publish_series_directory), so the directory never holds a mix of old and new
+# files.
+#
+# Series that share their directory (e.g., t1 and t2) are renamed into place
+# file by file. Their manifest is marked incomplete while files are renamed -
+# so that an interrupted update is redone by the next run - and complete once
+# files of the previous export that were not replaced are removed, the
+# published files are verified against the manifest and the EID file is
+# updated. A manifest that is incomplete or no longer matches the files has
+# the series exported again (see check_manifest_complete).
+#
+# Returns - True if new files were published, False if not
+#
+def publish_series( redcap_visit_id, session, scan, session_and_scan_list, staging_dir, to_directory, filename_pattern, eid_file_path, converter_log=None ):
+    staged_files = sorted( os.listdir( staging_dir ) )
+    images = [ f for f in staged_files if re.match( '.*\.nii(\.gz)?$', f ) ]
+    image_xml_files = [ f for f in staged_files if f.endswith( '.nii.xml' ) ]
+    if not len( images ) or sorted( [ re.sub( '\.gz$', '', f ) + '.xml' for f in images ] ) != image_xml_files:
+        slog.info(redcap_visit_id + "_" + scan,"Error: Conversion of series is incomplete",
+                  experiment_site_id = session,
+                  dest_dir = to_directory,
+                  files = str(staged_files))
         return False
 
-    # Get XNAT experiment object
-    experiment = xnat.select.experiments[ xnat_eid ]
+    if converter_log is not None:
+        logged_images = get_converter_images( converter_log, staging_dir )
+        if logged_images != images:
+            slog.info(redcap_visit_id + "_" + scan,"Error: Converted images do not match output of dcm2image",
+                      experiment_site_id = session,
+                      dest_dir = to_directory,
+                      staged_images = "%d: %s" % ( len( images ), str( images ) ),
+                      logged_images = "%d: %s" % ( len( logged_images ), str( logged_images ) ))
+            return False
 
-    # Get list of resource files that match the T1w image file name pattern
-    experiment_files = []
-    resource_list=get_resource_list(redcap_visit_id,xnat,xnat_eid,experiment.resources)
-    for resource in resource_list:
-        experiment_files += [ (file['cat_ID'], re.sub( '.*\/files\/', '', file['URI']) ) for file in resource if re.match( '^t1.nii.gz$', file['Name'] ) ]
+    manifest = dict( session_and_scan_list = session_and_scan_list,
+                     files = dict( ( f, dict( size = os.path.getsize( os.path.join( staging_dir, f ) ),
+                                              sha256 = get_file_checksum( os.path.join( staging_dir, f ) ) ) )
+                                   for f in staged_files ),
+                     complete = False )
+    manifest['hash'] = hashlib.sha256( json.dumps( manifest['files'], sort_keys=True ).encode() ).hexdigest()
+    manifest_path = get_manifest_path( eid_file_path )
+
+    # Files of the previous export of this series
+    pipeline_file_pattern = get_series_file_paths( to_directory, filename_pattern )[0]
+    previous_files = []
+    for xml_file in glob.glob( pipeline_file_pattern ):
+        nii_file = re.sub('.nii.xml','.nii',xml_file)
+        previous_files += [ xml_file, nii_file, nii_file + ".gz" ]
 
-    # No matching files - nothing to do
-    if len( experiment_files ) == 0:
+    if '%' in filename_pattern:
+        return publish_series_directory( redcap_visit_id, session, scan, session_and_scan_list, staging_dir, to_directory, eid_file_path, manifest, previous_files )
+
+    try: 
+        if not os.path.exists(to_directory):
+            os.makedirs(to_directory)
+
+        write_manifest( manifest_path, manifest )
+        for f in staged_files:
+            os.replace( os.path.join( staging_dir, f ), os.path.join( to_directory, f ) )
+
+        for previous_file in previous_files:
+            if os.path.basename( previous_file ) not in manifest['files'] and os.path.exists( previous_file ):
+                os.remove( previous_file )
+
+    except Exception as err_msg: 
+        error = "ERROR: unable to move files"
+        slog.info(redcap_visit_id + "_" + scan,error,
+                  experiment_site_id = session,
+                  src_dir = staging_dir ,
+                  dest_dir = to_directory,
+                  err_msg = str(err_msg))
         return False
 
-    # Get first file from list, warn if more files
-    (phantom_resource, phantom_file) = experiment_files[0]
-    experiment.resources[phantom_resource].files[ phantom_file ].download( phantom_path, verbose=False )
+    # Manifest stays incomplete, so the series is exported again
+    mismatches = get_manifest_mismatches( manifest, to_directory )
+    if mismatches:
+        slog.info(redcap_visit_id + "_" + scan,"ERROR: published files do not match manifest",
+                  experiment_site_id = session,
+                  dest_dir = to_directory,
+                  files = str(mismatches))
+        return False
 
+    try:
+        open( eid_file_path, 'w' ).writelines( session_and_scan_list )
+    except:
+        error = "ERROR: unable to write EID file"
+        slog.info(redcap_visit_id + "_" + scan,error,
+                  experiment_site_id=session,
+                  eid_file_path = eid_file_path)
+        return True
+
+    manifest['complete'] = True
+    write_manifest( manifest_path, manifest )
     return True
 
 #
-# Copy ADNI phantom XML file for structural session
+# Publish a series that has a directory of its own: the staging directory is
+# completed (EID file, complete manifest, and hard links to the files of the
+# current directory that are not part of the series, e.g., manual pipeline
+# files) and then swapped with the current directory. Renaming a directory onto
+# one that is not empty is not possible, so the current directory is renamed
+# aside first - readers find the old series, no directory for that instant, or
+# the new series, but never a mix of both.
 #
-# Returns - True if new file as created, False if not
+# Returns - True if the series was published, False if not
 #
-def copy_adni_phantom_xml( redcap_visit_id, xnat, xnat_eid, to_directory ):
-    # Check if target file already exists
-    phantom_path = os.path.join( to_directory, 'phantom.xml' )
-    if os.path.exists( phantom_path ):
+def publish_series_directory( redcap_visit_id, session, scan, session_and_scan_list, staging_dir, to_directory, eid_file_path, manifest, previous_files ):
+    to_directory = os.path.normpath( to_directory )
+    parent_dir = os.path.dirname( to_directory )
+    previous_prefix = '.' + os.path.basename( to_directory ) + '-previous-'
+
+    # Left over by an interrupted swap
+    for previous_dir in glob.glob( os.path.join( parent_dir, previous_prefix + '*' ) ):
+        shutil.rmtree( previous_dir, ignore_errors=True )
+
+    eid_file_name = os.path.basename( eid_file_path )
+    manifest_file_name = os.path.basename( get_manifest_path( eid_file_path ) )
+    series_files = set( [ os.path.basename( f ) for f in previous_files ] + [ eid_file_name, manifest_file_name, manifest_file_name + '.tmp' ] )
+
+    try:
+        if os.path.isdir( to_directory ):
+            for name in os.listdir( to_directory ):
+                if name in series_files or name in manifest['files']:
+                    continue
+
+                from_path = os.path.join( to_directory, name )
+                staged_path = os.path.join( staging_dir, name )
+                if os.path.islink( from_path ):
+                    os.symlink( os.readlink( from_path ), staged_path )
+                elif os.path.isdir( from_path ):
+                    shutil.copytree( from_path, staged_path, symlinks=True, copy_function=os.link )
+                else:
+                    os.link( from_path, staged_path )
+
+            os.chmod( staging_dir, stat.S_IMODE( os.stat( to_directory ).st_mode ) )
+        else:
+            # mkdtemp creates directories only the owner can access
+            os.chmod( staging_dir, stat.S_IMODE( os.stat( parent_dir ).st_mode ) )
+
+        with open( os.path.join( staging_dir, eid_file_name ), 'w' ) as eid_file:
+            eid_file.writelines( session_and_scan_list )
+
+        manifest['complete'] = True
+        write_manifest( os.path.join( staging_dir, manifest_file_name ), manifest )
+
+        if os.path.exists( to_directory ):
+            previous_dir = tempfile.mkdtemp( prefix=previous_prefix, dir=parent_dir )
+            os.rename( to_directory, os.path.join( previous_dir, 'series' ) )
+            try:
+                os.rename( staging_dir, to_directory )
+            except:
+                os.rename( os.path.join( previous_dir, 'series' ), to_directory )
+                raise
+            shutil.rmtree( previous_dir, ignore_errors=True )
+        else:
+            os.rename( staging_dir, to_directory )
+
+    except Exception as err_msg:
+        slog.info(redcap_visit_id + "_" + scan,"ERROR: unable to publish series directory",
+                  experiment_site_id = session,
+                  src_dir = staging_dir,
+                  dest_dir = to_directory,
+                  err_msg = str(err_msg))
         return False
 
-    # Get XNAT experiment object
+    return True
+
+#
+# XNAT resource file listings of experiments, cached for the run - see
+# get_resource_list
+#
+resource_list_cache = dict()
+
+#
+# Get the first file of an experiment's resources whose name matches the pattern
+#
+# Returns - (pyxnat file object, file entry of resource listing), or (None, None)
+#
+def get_experiment_file( redcap_visit_id, xnat, xnat_eid, pattern ):
     experiment = xnat.select.experiments[ xnat_eid ]
+    for resource in get_resource_list( redcap_visit_id, xnat, xnat_eid, experiment.resources ):
+        for file in resource:
+            if re.match( pattern, file['Name'] ):
+                return ( experiment.resources[ file['cat_ID'] ].files[ re.sub( '.*\/files\/', '', file['URI'] ) ], file )
 
-    # Get list of resource files that match the phantom XML file name pattern
-    experiment_files = []
-    resource_list=get_resource_list(redcap_visit_id,xnat,xnat_eid,experiment.resources)
-    for resource in resource_list:
-        experiment_files += [ (file['cat_ID'], re.sub( '.*\/files\/', '', file['URI']) ) for file in resource if re.match( '^phantom.xml$', file['Name'] ) ]
+    return ( None, None )
+
+#
+# Copy ADNI phantom T1w image file for structural session with transfers (see
+# pipeline_file_transfers.FileTransfers)
+#
+# Returns - True if file is copied, False if not
+#
+def copy_adni_phantom_t1w( redcap_visit_id, xnat, xnat_eid, to_directory, transfers ):
+    (phantom_file, file_entry) = get_experiment_file( redcap_visit_id, xnat, xnat_eid, '^t1.nii.gz$' )
 
     # No matching files - nothing to do
-    if len( experiment_files ) == 0:
+    if not phantom_file:
         return False
 
-    # Get first file from list, warn if more files
-    (phantom_resource, phantom_file) = experiment_files[0]
-    experiment.resources[ phantom_resource ].files[ phantom_file ].download( phantom_path, verbose=False )
+    return transfers.add( phantom_file, file_entry, os.path.join( to_directory, 'phantom_t1.nii.gz' ) )
 
-    return True
+#
+# Copy ADNI phantom XML file for structural session with transfers
+#
+# Returns - True if file is copied, False if not
+#
+def copy_adni_phantom_xml( redcap_visit_id, xnat, xnat_eid, to_directory, transfers ):
+    (phantom_file, file_entry) = get_experiment_file( redcap_visit_id, xnat, xnat_eid, '^phantom.xml$' )
+
+    # No matching files - nothing to do
+    if not phantom_file:
+        return False
+
+    return transfers.add( phantom_file, file_entry, os.path.join( to_directory, 'phantom.xml' ) )
+
+#
+# Reformat line of Siemens add-on physio file to tab-separated columns
+#
+def convert_siemens_physio_line( line ):
+    match = re.match( '^.* - Voltage - (.*)\t.* - Voltage - (.*)\t.* - Voltage - (.*)$', line )
+    if match:
+        return '%s\t%s\t%s\n' % ( match.group(1), match.group(2), match.group(3) )
+
+    match = re.match( '^[0-9]{1,2}/[0-9]{1,2}/[0-9]{1,4}\s+(.*)\s+[0-9]{1,2}/[0-9]{1,2}/[0-9]{1,4}\s+(.*)\s+[0-9]{1,2}/[0-9]{1,2}/[0-9]{1,4}\s+(.*)$', line )
+    if match:
+        return '%s\t%s\t%s\n' % ( match.group(1), match.group(2), match.group(3) )
+
+    return line
 
 #
-# Compress physio file in pipeline workdir
+# Compress downloaded physio file into pipeline workdir (as "gzip -9" would),
+# reformatting each line with convert_line if given. The compressed file
+# only appears once complete.
 #
-def gzip_physio( physio_file_path ):
-    (ecode,sout,eout) = sutils.gzip('-9f ' + str(physio_file_path))
-    if ecode : 
-        error = "ERROR: unable to compress physio file"
-        slog.info(physio_file_path,error, err_msg = str(eout))
+def gzip_physio( from_path, physio_gz_path, convert_line=None ):
+    partial_path = physio_gz_path + '.part'
+    try:
+        with open( partial_path, 'wb' ) as raw_file:
+            with gzip.GzipFile( filename=re.sub( '\.gz$', '', os.path.basename( physio_gz_path ) ), mode='wb', compresslevel=9, fileobj=raw_file ) as gz_file:
+                if convert_line:
+                    with io.TextIOWrapper( gz_file ) as to_file, open( from_path, 'r' ) as from_file:
+                        for line in from_file:
+                            to_file.write( convert_line( line ) )
+                else:
+                    with open( from_path, 'rb' ) as from_file:
+                        shutil.copyfileobj( from_file, gz_file )
+
+        os.replace( partial_path, physio_gz_path )
+    finally:
+        if os.path.exists( partial_path ):
+            os.remove( partial_path )
 
 def get_resource_list(redcap_visit_id,xnat,xnat_eid,exp_resources):
+    if xnat_eid in resource_list_cache:
+        return resource_list_cache[xnat_eid]
 
     resource_list=[]
+    complete=True
     for resource in exp_resources.listing:
         uri='/data/experiments/%s/resources/%s/files' % ( xnat_eid, resource.id )
         try : 
@@ -258,15 +612,21 @@ def get_resource_list(redcap_visit_id,xnat,xnat_eid,exp_resources):
                     raise RuntimeError("cat_id was different than resource.id for", uri,str(file))
             
         except Exception as err_msg:
+            complete=False
             slog.info(redcap_visit_id, "WARNING: Could not retrieve" + uri  + " from xnat.", error_msg=str(err_msg),info="Modt likely file data of session is outdated - to update file data load session in xnat, select 'Manage Files', and press 'Update File Data'!", resource_dir=resource.label,resource_id=resource.id)
 
+    # Incomplete listings are retried by the next caller
+    if complete:
+        resource_list_cache[xnat_eid] = resource_list
+
     return resource_list
 
 # Copy physio files (cardio and respiratory) for resting-state fMRI session
+# with transfers. Physio files are stored compressed.
 #
-# Returns - True if new file as created, False if not
+# Returns - True if files are copied, False if not
 #
-def copy_rsfmri_physio_files( redcap_visit_id, xnat, xnat_eid_and_scan, to_directory ):
+def copy_rsfmri_physio_files( redcap_visit_id, xnat, xnat_eid_and_scan, to_directory, transfers ):
     # Extract EID and scan from EID/Scan string
     match = re.match( '^(NCANDA_E[0-9]*)/([0-9]+).*', xnat_eid_and_scan )
     if not match:
@@ -294,65 +654,30 @@ def copy_rsfmri_physio_files( redcap_visit_id, xnat, xnat_eid_and_scan, to_direc
     resource_list=get_resource_list(redcap_visit_id,xnat,xnat_eid,experiment.resources)
     for resource in resource_list:
         for (pattern,outfile_name) in list(physio_filename_patterns.items()):
-             physio_files += [ (file['cat_ID'], re.sub( '.*\/files\/', '', file['URI']), outfile_name ) for file in resource if re.match( pattern, file['Name'] ) ]
-
-    # No matching files - nothing to do
-    if len( physio_files ) == 0:
-        return False
-
-    files_created = False
-    for physio in physio_files:
-        (physio_resource, physio_file, outfile_name) = physio
-
-        # What will be the output file name? Does it already exist?
+             physio_files += [ (file['cat_ID'], re.sub( '.*\/files\/', '', file['URI']), outfile_name, file ) for file in resource if re.match( pattern, file['Name'] ) ]
+
+    files_copied = False
+    for (physio_resource, physio_file, outfile_name, file_entry) in physio_files:
+        if not '.txt' in physio_file:
+            postprocess = gzip_physio
+        elif not 'Stroop' in physio_file:
+            # Siemens add-on single file
+            postprocess = lambda from_path, to_path: gzip_physio( from_path, to_path, convert_line=convert_siemens_physio_line )
+        else:
+            continue
+
+        # Uncompressed output files are left over from earlier versions
         physio_file_path = os.path.join( to_directory, outfile_name )
-        if not ( os.path.exists( physio_file_path ) or os.path.exists( physio_file_path+'.gz' ) ):
-            # Does output directory exist? Create if not
-            if not os.path.exists( to_directory ):
-                os.makedirs( to_directory )
-
-            # determine a temporary target location
-            (fh, physio_file_path_cache) = tempfile.mkstemp(suffix='physio_cache')
-            # fh is integer - if object is needed use tempfile.TemporaryFile()
-            # fh.close()
-
-            experiment.resources[ physio_resource ].files[ physio_file ].download(physio_file_path_cache, verbose=False)
-
-            if not '.txt' in physio_file:
-                shutil.move( physio_file_path_cache, physio_file_path )
-                gzip_physio( physio_file_path )
-                files_created = True
-            elif not 'Stroop' in physio_file:
-                # Siemens add-on single file
-                try:
-                    to_file = open( physio_file_path, 'w' )
-                    for line in open( physio_file_path_cache ).readlines():
-                        match = re.match( '^.* - Voltage - (.*)\t.* - Voltage - (.*)\t.* - Voltage - (.*)$', line )
-                        if match:
-                            to_file.write( '%s\t%s\t%s\n' % ( match.group(1), match.group(2), match.group(3) ) )
-                        else:
-                            match = re.match( '^[0-9]{1,2}/[0-9]{1,2}/[0-9]{1,4}\s+(.*)\s+[0-9]{1,2}/[0-9]{1,2}/[0-9]{1,4}\s+(.*)\s+[0-9]{1,2}/[0-9]{1,2}/[0-9]{1,4}\s+(.*)$', line )
-                            if match:
-                                to_file.write( '%s\t%s\t%s\n' % ( match.group(1), match.group(2), match.group(3) ) )
-                            else:
-                                to_file.write( line )
-
-                    gzip_physio( physio_file_path )
-                    files_created = True
-                finally:
-                    to_file.close()
-            
-            # remove cached file
-            shutil.rmtree(physio_file_path_cache, ignore_errors=True)
+        files_copied = transfers.add( experiment.resources[ physio_resource ].files[ physio_file ], file_entry, physio_file_path + '.gz', postprocess=postprocess, existing_paths=[ physio_file_path ] ) or files_copied
 
-    return files_created
+    return files_copied
 
 #
-# Copy manual pipeline override files
+# Copy manual pipeline override files with transfers
 #
-# Returns - True if new file as created, False if not
+# Returns - True if files are copied, False if not
 #
-def copy_manual_pipeline_files( redcap_visit_id, xnat, xnat_eid, to_directory ):
+def copy_manual_pipeline_files( redcap_visit_id, xnat, xnat_eid, to_directory, transfers ):
     # Get XNAT experiment object
     experiment = xnat.select.experiments[ xnat_eid ]
 
@@ -360,26 +685,13 @@ def copy_manual_pipeline_files( redcap_visit_id, xnat, xnat_eid, to_directory ):
     files = []
     resource_list=get_resource_list(redcap_visit_id,xnat,xnat_eid,experiment.resources)
     for resource in resource_list:
-        files += [ (file['cat_ID'], re.sub( '.*\/files\/', '', file['URI']) ) for file in resource if file['collection'] == 'pipeline' ]
-
-        # No matching files - nothing to do
-    if len( files ) == 0:
-        return False
+        files += [ (file['cat_ID'], re.sub( '.*\/files\/', '', file['URI']), file ) for file in resource if file['collection'] == 'pipeline' ]
 
-    files_created = False
-    for (resource,file_name) in files:
-        file_path = os.path.join( to_directory, file_name )
-        file_dir = os.path.dirname( file_path )
-        if not os.path.exists( file_path ):
-            # Does output directory exist? Create if not
-            if not os.path.exists( file_dir ):
-                os.makedirs( file_dir )
+    files_copied = False
+    for (resource,file_name,file_entry) in files:
+        files_copied = transfers.add( experiment.resources[resource].files[file_name], file_entry, os.path.join( to_directory, file_name ) ) or files_copied
 
-            experiment.resources[resource].files[file_name].download(file_path, verbose=False)
- 
-            files_created = True
-
-    return files_created
+    return files_copied
 
 
 def delete_workdir(workdir,redcap_visit_id,verbose=False): 
@@ -393,12 +705,16 @@ def delete_workdir(workdir,redcap_visit_id,verbose=False):
                       err_msg = str(err_msg))
 
 #
-# Export MR images and associated data to pipeline directory tree.
+# Export MR images and associated data to pipeline directory tree. With an
+# export_queue, series conversions are queued rather than run right away.
+# Auxiliary files (phantom, physio and manual pipeline files) are copied from
+# XNAT by transfer_jobs concurrent downloads.
 #
 # Returns - True if new file as created, False if not
 #
-def export_to_workdir( redcap_visit_id, xnat, session_data, pipeline_workdir, redcap_key, xnat_dir, stroop=(None,None,None), verbose=False, timerFlag=False):
+def export_to_workdir( redcap_visit_id, xnat, session_data, pipeline_workdir, redcap_key, xnat_dir, stroop=(None,None,None), verbose=False, timerFlag=False, export_queue=None, transfer_jobs=4):
     new_files_created = False
+    transfers = FileTransfers( redcap_visit_id, pipeline_workdir, max_jobs=transfer_jobs, verbose=verbose )
 
     # Export structural data
     pipeline_workdir_structural_main = os.path.join( pipeline_workdir, 'structural');
@@ -409,14 +725,14 @@ def export_to_workdir( redcap_visit_id, xnat, session_data, pipeline_workdir, re
         else :
             timerLabel = None
 
-        new_files_created = export_series( redcap_visit_id, xnat, redcap_key, session_data['mri_series_t1'], pipeline_workdir_structural_native, 't1.nii', xnat_dir, verbose=verbose, timer_label= timerLabel ) or new_files_created
+        new_files_created = export_series( redcap_visit_id, xnat, redcap_key, session_data['mri_series_t1'], pipeline_workdir_structural_native, 't1.nii', xnat_dir, verbose=verbose, timer_label= timerLabel , export_queue=export_queue ) or new_files_created
 
-        new_files_created = export_series( redcap_visit_id, xnat, redcap_key, session_data['mri_series_t2'], pipeline_workdir_structural_native, 't2.nii', xnat_dir, verbose=verbose) or new_files_created
+        new_files_created = export_series( redcap_visit_id, xnat, redcap_key, session_data['mri_series_t2'], pipeline_workdir_structural_native, 't2.nii', xnat_dir, verbose=verbose, export_queue=export_queue ) or new_files_created
 
         # Copy ADNI phantom XML file
         if 'NCANDA_E' in session_data['mri_adni_phantom_eid']:
-            new_files_created = copy_adni_phantom_xml( redcap_visit_id, xnat, session_data['mri_adni_phantom_eid'], pipeline_workdir_structural_native ) or new_files_created
-            new_files_created = copy_adni_phantom_t1w( redcap_visit_id, xnat, session_data['mri_adni_phantom_eid'], pipeline_workdir_structural_native ) or new_files_created
+            copy_adni_phantom_xml( redcap_visit_id, xnat, session_data['mri_adni_phantom_eid'], pipeline_workdir_structural_native, transfers )
+            copy_adni_phantom_t1w( redcap_visit_id, xnat, session_data['mri_adni_phantom_eid'], pipeline_workdir_structural_native, transfers )
 
     else :
         delete_workdir(pipeline_workdir_structural_main,redcap_visit_id,verbose)
@@ -425,15 +741,15 @@ def export_to_workdir( redcap_visit_id, xnat, session_data, pipeline_workdir, re
     pipeline_workdir_diffusion_main = os.path.join( pipeline_workdir, 'diffusion' );
     pipeline_workdir_diffusion_native = os.path.join(pipeline_workdir_diffusion_main, 'native' );
     if session_data['mri_series_dti6b500pepolar'] != '' and session_data['mri_series_dti60b1000'] != '':
-        new_files_created = export_series( redcap_visit_id, xnat, redcap_key, session_data['mri_series_dti6b500pepolar'], os.path.join( pipeline_workdir_diffusion_native, 'dti6b500pepolar' ), 'dti6-%n.nii', xnat_dir, verbose=verbose ) or new_files_created
+        new_files_created = export_series( redcap_visit_id, xnat, redcap_key, session_data['mri_series_dti6b500pepolar'], os.path.join( pipeline_workdir_diffusion_native, 'dti6b500pepolar' ), 'dti6-%n.nii', xnat_dir, verbose=verbose , export_queue=export_queue ) or new_files_created
 
-        new_files_created = export_series( redcap_visit_id, xnat, redcap_key, session_data['mri_series_dti60b1000'], os.path.join( pipeline_workdir_diffusion_native, 'dti60b1000' ), 'dti60-%n.nii', xnat_dir, verbose=verbose ) or new_files_created
+        new_files_created = export_series( redcap_visit_id, xnat, redcap_key, session_data['mri_series_dti60b1000'], os.path.join( pipeline_workdir_diffusion_native, 'dti60b1000' ), 'dti60-%n.nii', xnat_dir, verbose=verbose , export_queue=export_queue ) or new_files_created
 
         if session_data['mri_series_dti30b400'] != '' :
-            new_files_created = export_series( redcap_visit_id, xnat, redcap_key, session_data['mri_series_dti30b400'], os.path.join( pipeline_workdir_diffusion_native, 'dti30b400' ), 'dti30-%n.nii', xnat_dir, verbose=verbose ) or new_files_created
+            new_files_created = export_series( redcap_visit_id, xnat, redcap_key, session_data['mri_series_dti30b400'], os.path.join( pipeline_workdir_diffusion_native, 'dti30b400' ), 'dti30-%n.nii', xnat_dir, verbose=verbose , export_queue=export_queue ) or new_files_created
 
         if session_data['mri_series_dti_fieldmap'] != '':
-            new_files_created = export_series( redcap_visit_id, xnat, redcap_key, session_data['mri_series_dti_fieldmap'], os.path.join( pipeline_workdir_diffusion_native, 'fieldmap' ), 'fieldmap-%T%N.nii', xnat_dir, verbose=verbose ) or new_files_created
+            new_files_created = export_series( redcap_visit_id, xnat, redcap_key, session_data['mri_series_dti_fieldmap'], os.path.join( pipeline_workdir_diffusion_native, 'fieldmap' ), 'fieldmap-%T%N.nii', xnat_dir, verbose=verbose , export_queue=export_queue ) or new_files_created
         
 
     else :
@@ -448,11 +764,11 @@ def export_to_workdir( redcap_visit_id, xnat, session_data, pipeline_workdir, re
         else :
             timerLabel = None
 
-        new_files_created = export_series( redcap_visit_id, xnat, redcap_key, session_data['mri_series_rsfmri'], os.path.join( pipeline_workdir_functional_native, 'rs-fMRI' ), 'bold-%n.nii', xnat_dir, verbose=verbose, timer_label = timerLabel ) or new_files_created
+        new_files_created = export_series( redcap_visit_id, xnat, redcap_key, session_data['mri_series_rsfmri'], os.path.join( pipeline_workdir_functional_native, 'rs-fMRI' ), 'bold-%n.nii', xnat_dir, verbose=verbose, timer_label = timerLabel , export_queue=export_queue ) or new_files_created
         # Copy rs-fMRI physio files
-        new_files_created = copy_rsfmri_physio_files( redcap_visit_id, xnat, session_data['mri_series_rsfmri'], os.path.join( pipeline_workdir_functional_native, 'physio' ) ) or new_files_created
+        copy_rsfmri_physio_files( redcap_visit_id, xnat, session_data['mri_series_rsfmri'], os.path.join( pipeline_workdir_functional_native, 'physio' ), transfers )
 
-        new_files_created = export_series( redcap_visit_id, xnat, redcap_key, session_data['mri_series_rsfmri_fieldmap'], os.path.join( pipeline_workdir_functional_native, 'fieldmap' ), 'fieldmap-%T%N.nii', xnat_dir, verbose=verbose ) or new_files_created
+        new_files_created = export_series( redcap_visit_id, xnat, redcap_key, session_data['mri_series_rsfmri_fieldmap'], os.path.join( pipeline_workdir_functional_native, 'fieldmap' ), 'fieldmap-%T%N.nii', xnat_dir, verbose=verbose , export_queue=export_queue ) or new_files_created
 
     else :
         delete_workdir(pipeline_workdir_functional_main,redcap_visit_id,verbose)
@@ -475,7 +791,10 @@ def export_to_workdir( redcap_visit_id, xnat, session_data, pipeline_workdir, re
     #   First, extract "Experiment ID" part from each "EID/SCAN" string, unless empty, then make into set of unique IDs.
     all_sessions = set( [ eid for eid in [ re.sub( '/.*', '', session_data[series] ) for series in list(session_data.keys()) if 'mri_series_' in series ] if 'NCANDA_E' in eid ] )
     for session in all_sessions:
-        new_files_created = copy_manual_pipeline_files( redcap_visit_id, xnat, session, pipeline_workdir ) or new_files_created
+        copy_manual_pipeline_files( redcap_visit_id, xnat, session, pipeline_workdir, transfers )
+
+    # Wait for the copies of all auxiliary files
+    new_files_created = transfers.finish() or new_files_created
 
     return new_files_created
 
@@ -484,9 +803,28 @@ def export_to_workdir( redcap_visit_id, xnat, session_data, pipeline_workdir, re
 #
 
 #
-# Export MR session and run pipeline if so instructed
+# Submit image processing pipeline for a visit work directory to the cluster
 #
-def export_and_queue(red2cas, redcap_visit_id, xnat, session_data, redcap_key, pipeline_root_dir, xnat_dir,stroop=(None,None,None), run_pipeline_script=None, verbose=False, timerFlag = False ):
+def submit_pipeline_run(red2cas, pipeline_root_dir, pipeline_workdir_rel, run_pipeline_script, subject_code, visit_code, verbose=False):
+    pipeline_workdir = os.path.join( pipeline_root_dir, pipeline_workdir_rel )
+    if verbose:
+        print('Submitting script',run_pipeline_script,'to process',pipeline_workdir)
+    just_pipeline_script=os.path.basename(run_pipeline_script)
+    qsub_exe = 'cd %s; %s %s' % ( pipeline_root_dir,run_pipeline_script,pipeline_workdir_rel)
+    # Changed title so it is informative when displayed in short form through qsub
+
+    job_title = subject_code[7:] + visit_code[0] + visit_code[9:] + '-' + just_pipeline_script
+    log_file = '/fs/ncanda-share/log/export_mr_sessions_pipeline/' + job_title + '.txt'
+    red2cas.schedule_cluster_job(qsub_exe,'N%s-Nightly' % (job_title),submit_log=log_file, verbose = verbose)
+
+#
+# Export MR session and run pipeline if so instructed. With an export_queue
+# (see pipeline_export_queue.ExportQueue), series conversions are queued and
+# the pipeline is submitted once they are done.
+#
+# Returns - True if new files were created or queued, False if not
+#
+def export_and_queue(red2cas, redcap_visit_id, xnat, session_data, redcap_key, pipeline_root_dir, xnat_dir,stroop=(None,None,None), run_pipeline_script=None, verbose=False, timerFlag = False, export_queue=None, transfer_jobs=4 ):
     (subject_label, event_label) = redcap_key
     # Put together pipeline work directory for this subject and visit
     subject_code = session_data['mri_xnat_sid']
@@ -505,18 +843,21 @@ def export_and_queue(red2cas, redcap_visit_id, xnat, session_data, redcap_key, p
     if verbose:
         print(subject_label,'/',subject_code,'/',event_label,'to',pipeline_workdir)
 
-    new_files_created = export_to_workdir(redcap_visit_id,xnat, session_data, pipeline_workdir, redcap_key, xnat_dir, stroop=stroop, verbose=verbose, timerFlag= timerFlag)
-
-    if (new_files_created and run_pipeline_script):
-        if verbose:
-            print('Submitting script',run_pipeline_script,'to process',pipeline_workdir)
-        just_pipeline_script=os.path.basename(run_pipeline_script)
-        qsub_exe = 'cd %s; %s %s' % ( pipeline_root_dir,run_pipeline_script,pipeline_workdir_rel)
-        # Changed title so it is informative when displayed in short form through qsub
-
-        job_title = subject_code[7:] + visit_code[0] + visit_code[9:] + '-' + just_pipeline_script
-        log_file = '/fs/ncanda-share/log/export_mr_sessions_pipeline/' + job_title + '.txt'
-        red2cas.schedule_cluster_job(qsub_exe,'N%s-Nightly' % (job_title),submit_log=log_file, verbose = verbose)
+    new_files_created = export_to_workdir(redcap_visit_id,xnat, session_data, pipeline_workdir, redcap_key, xnat_dir, stroop=stroop, verbose=verbose, timerFlag= timerFlag, export_queue=export_queue, transfer_jobs=transfer_jobs)
+
+    if export_queue and export_queue.has_conversions(redcap_visit_id):
+        if run_pipeline_script:
+            export_queue.add_pipeline_run(redcap_visit_id,
+                                          dict(pipeline_root_dir=pipeline_root_dir,
+                                               pipeline_workdir_rel=pipeline_workdir_rel,
+                                               run_pipeline_script=run_pipeline_script,
+                                               subject_code=subject_code,
+                                               visit_code=visit_code),
+                                          new_files_created)
+        new_files_created = True
+
+    elif (new_files_created and run_pipeline_script):
+        submit_pipeline_run(red2cas, pipeline_root_dir, pipeline_workdir_rel, run_pipeline_script, subject_code, visit_code, verbose=verbose)
             
     # It is very important to clear the PyXNAT cache, lest we run out of disk space and shut down all databases in the process
     try:
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+
+##
+##  See COPYING file distributed along with the ncanda-data-integration package
+##  for the copyright and license terms
+##
+
+from __future__ import print_function
+import json
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from sibispy import sibislogger as slog
+
+
+class ExportQueue(object):
+    """
+    Durable queue of the series conversions (DICOM to NIfTI) that export the MR
+    sessions of visits to the image pipeline.
+
+    Conversions are kept in a sqlite database until they are done, so that
+    those left unfinished by a crashed run are picked up again by the next run.
+    They are run by a pool of max_jobs workers and attempted up to max_attempts
+    times. Pipeline runs of a visit are submitted once all of its conversions
+    are finished (see finish).
+
+    A conversion is claimed by a single worker (status pending -> running). If
+    the same target is queued again while it is running, the new job is kept
+    (status requeued) and run by that worker once the current one is done, so
+    that no two conversions write into the same directory at once.
+
+    convert is called with the keyword arguments passed to enqueue_conversion
+    and returns True if the conversion created new files.
+    """
+
+    def __init__(self, queue_file, convert, max_jobs=2, max_attempts=2, verbose=False):
+        self.convert = convert
+        self.max_attempts = max_attempts
+        self.verbose = verbose
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_jobs)
+        self._futures = []
+
+        self._connection = sqlite3.connect(queue_file, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS conversions ("
+                " target TEXT PRIMARY KEY, redcap_visit_id TEXT, job TEXT,"
+                " status TEXT, attempts INTEGER)"
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS pipeline_runs ("
+                " redcap_visit_id TEXT PRIMARY KEY, run TEXT, new_files INTEGER)"
+            )
+            # Conversions that were running when the last run stopped are redone
+            self._connection.execute(
+                "UPDATE conversions SET status = 'pending'"
+                " WHERE status IN ('running', 'requeued')"
+            )
+
+    def _execute(self, sql, parameters=()):
+        with self._lock, self._connection:
+            return self._connection.execute(sql, parameters).fetchall()
+
+    def start(self):
+        """
+        Start converting all pending conversions, including those left over
+        by earlier runs.
+        """
+        for (target,) in self._execute(
+            "SELECT target FROM conversions WHERE status = 'pending'"
+        ):
+            self._futures.append(self._executor.submit(self._run, target))
+
+    def enqueue_conversion(
+        self,
+        redcap_visit_id,
+        session,
+        scan,
+        session_and_scan_list,
+        dicom_path_list,
+        to_directory,
+        filename_pattern,
+        eid_file_path,
+    ):
+        job = dict(
+            redcap_visit_id=redcap_visit_id,
+            session=session,
+            scan=scan,
+            session_and_scan_list=session_and_scan_list,
+            dicom_path_list=dicom_path_list,
+            to_directory=to_directory,
+            filename_pattern=filename_pattern,
+            eid_file_path=eid_file_path,
+        )
+        target = json.dumps([to_directory, filename_pattern])
+
+        with self._lock, self._connection:
+            queued = self._connection.execute(
+                "SELECT job, status FROM conversions WHERE target = ?"
+                " AND status IN ('pending', 'running', 'requeued')",
+                (target,),
+            ).fetchone()
+
+            # The same conversion might still be waiting from an earlier run
+            if queued and json.loads(queued[0]) == job:
+                return
+
+            # Run by the worker converting the target once it is done
+            if queued and queued[1] in ('running', 'requeued'):
+                self._connection.execute(
+                    "UPDATE conversions SET redcap_visit_id = ?, job = ?,"
+                    " status = 'requeued', attempts = 0 WHERE target = ?",
+                    (redcap_visit_id, json.dumps(job), target),
+                )
+                return
+
+            self._connection.execute(
+                "INSERT OR REPLACE INTO conversions VALUES (?, ?, ?, 'pending', 0)",
+                (target, redcap_visit_id, json.dumps(job)),
+            )
+        self._futures.append(self._executor.submit(self._run, target))
+
+    def has_conversions(self, redcap_visit_id):
+        return len(
+            self._execute(
+                "SELECT target FROM conversions WHERE redcap_visit_id = ?",
+                (redcap_visit_id,),
+            )
+        ) > 0
+
+    def add_pipeline_run(self, redcap_visit_id, run, new_files_created):
+        """
+        Submit the pipeline run for the visit once its conversions are done -
+        run holds the keyword arguments of the function passed to finish.
+        """
+        # Keep new files reported for the visit by an earlier, unfinished run
+        previous = self._execute(
+            "SELECT new_files FROM pipeline_runs WHERE redcap_visit_id = ?",
+            (redcap_visit_id,),
+        )
+        if previous and previous[0][0]:
+            new_files_created = True
+
+        self._execute(
+            "INSERT OR REPLACE INTO pipeline_runs VALUES (?, ?, ?)",
+            (redcap_visit_id, json.dumps(run), int(new_files_created)),
+        )
+
+    def _claim(self, target, status):
+        """
+        Set the conversion of target to running if its status is status -
+        returns its job and attempts, or None if another worker has it.
+        """
+        with self._lock, self._connection:
+            claimed = self._connection.execute(
+                "UPDATE conversions SET status = 'running' WHERE target = ?"
+                " AND status = ?",
+                (target, status),
+            ).rowcount
+            if not claimed:
+                return None
+
+            (job, attempts) = self._connection.execute(
+                "SELECT job, attempts FROM conversions WHERE target = ?", (target,)
+            ).fetchone()
+        return (json.loads(job), attempts)
+
+    def _run(self, target):
+        claimed = self._claim(target, "pending")
+        while claimed:
+            (job, attempts) = claimed
+            (status, attempts) = self._convert(job, attempts)
+
+            # Unless the conversion was queued again with new scans meanwhile,
+            # which is then run right away
+            with self._lock, self._connection:
+                updated = self._connection.execute(
+                    "UPDATE conversions SET status = ?, attempts = ? WHERE target = ?"
+                    " AND status = 'running'",
+                    (status, attempts, target),
+                ).rowcount
+            claimed = None if updated else self._claim(target, "requeued")
+
+    def _convert(self, job, attempts):
+        status = "failed"
+        while attempts < self.max_attempts:
+            attempts += 1
+            try:
+                if self.convert(**job):
+                    status = "done"
+                    break
+            except Exception as err_msg:
+                slog.info(
+                    job["redcap_visit_id"],
+                    "ERROR: export of series to pipeline failed",
+                    session_and_scan_list=job["session_and_scan_list"],
+                    to_directory=job["to_directory"],
+                    attempt=attempts,
+                    err_msg=str(err_msg),
+                )
+
+        if self.verbose:
+            print("Export of", job["session_and_scan_list"], "to", job["to_directory"], status)
+
+        return (status, attempts)
+
+    def finish(self, submit_pipeline_run):
+        """
+        Wait for all conversions, then submit the pipeline runs of visits that
+        have new files, calling submit_pipeline_run(**run).
+        """
+        self._executor.shutdown(wait=True)
+        for future in self._futures:
+            # Errors are reported by _run - just make sure none is lost
+            try:
+                future.result()
+            except Exception as err_msg:
+                slog.info("export_mr_sessions_pipeline", "ERROR: export queue failed", err_msg=str(err_msg))
+
+        for (redcap_visit_id, run, new_files) in self._execute(
+            "SELECT redcap_visit_id, run, new_files FROM pipeline_runs"
+        ):
+            converted = self._execute(
+                "SELECT target FROM conversions WHERE redcap_visit_id = ? AND status = 'done'",
+                (redcap_visit_id,),
+            )
+            if new_files or converted:
+                submit_pipeline_run(**json.loads(run))
+
+            self._execute(
+                "DELETE FROM pipeline_runs WHERE redcap_visit_id = ?", (redcap_visit_id,)
+            )
+
+        # Failed conversions are found again by the next run, as their EID
+        # files were not updated
+        self._execute("DELETE FROM conversions WHERE status IN ('done', 'failed')")
+        self._connection.close()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+##
+##  See COPYING file distributed along with the ncanda-data-integration package
+##  for the copyright and license terms
+##
+
+from __future__ import print_function
+import os
+import json
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from sibispy import sibislogger as slog
+
+# Name of the file in the pipeline work directory of a visit that records the
+# XNAT files copied into it
+TRANSFER_LOG_NAME = '.xnat_transfers.json'
+
+
+class FileTransfers(object):
+    """
+    Downloads of the auxiliary files of a visit (physio files, phantom files,
+    manual pipeline override files) from XNAT into its pipeline work directory.
+
+    Files are added with add() and downloaded by a pool of max_jobs workers;
+    finish() waits for all of them. Size and digest (as listed by XNAT) of every
+    copied file are recorded in the transfer log of the work directory - a
+    target file that exists is downloaded again only if its recorded URI, size
+    or digest differ from those of the file in XNAT.
+    """
+
+    def __init__(self, redcap_visit_id, pipeline_workdir, max_jobs=4, verbose=False):
+        self.redcap_visit_id = redcap_visit_id
+        self.verbose = verbose
+        self._workdir = pipeline_workdir
+        self._log_path = os.path.join(pipeline_workdir, TRANSFER_LOG_NAME)
+        self._log = dict()
+        try:
+            with open(self._log_path, 'r') as log_file:
+                self._log = json.load(log_file)
+        except (IOError, OSError, ValueError):
+            pass
+
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_jobs)
+        self._futures = []
+        self._targets = set()
+        self._log_changed = False
+
+    def _is_current(self, target_path, file_entry):
+        if not os.path.exists(target_path):
+            return False
+
+        recorded = self._log.get(self._get_key(target_path))
+        if recorded is None:
+            # Copied before transfers were logged - keep it and log it
+            self._record(target_path, file_entry)
+            return True
+
+        return recorded == self._get_version(file_entry)
+
+    def _get_key(self, target_path):
+        # Relative to the work directory, so that the log survives moving it
+        return os.path.relpath(target_path, self._workdir)
+
+    def _get_version(self, file_entry):
+        return dict(uri=file_entry.get('URI'),
+                    size=file_entry.get('Size'),
+                    digest=file_entry.get('digest'))
+
+    def _record(self, target_path, file_entry):
+        with self._lock:
+            self._log[self._get_key(target_path)] = self._get_version(file_entry)
+            self._log_changed = True
+
+    def add(self, xnat_file, file_entry, target_path, postprocess=None, existing_paths=()):
+        """
+        Queue download of xnat_file (pyxnat file object) to target_path, unless
+        it is there already and unchanged. file_entry is the file's entry of
+        the XNAT resource listing.
+
+        postprocess(download_path, target_path) turns the downloaded file into
+        the target file - the download is moved to the target if not given.
+        Nothing is downloaded if one of existing_paths exists.
+
+        Returns - True if the file is downloaded, False if not
+        """
+        # The first file added for a target wins
+        if target_path in self._targets:
+            return False
+        self._targets.add(target_path)
+
+        if any(os.path.exists(path) for path in existing_paths):
+            return False
+        if self._is_current(target_path, file_entry):
+            return False
+
+        self._futures.append(self._executor.submit(self._transfer, xnat_file, file_entry, target_path, postprocess))
+        return True
+
+    def _transfer(self, xnat_file, file_entry, target_path, postprocess):
+        target_dir = os.path.dirname(target_path)
+        if not os.path.exists(target_dir):
+            try:
+                os.makedirs(target_dir)
+            except OSError:
+                # Created by another transfer meanwhile
+                pass
+
+        # Download next to the target, so that an interrupted transfer never
+        # leaves a partial target file
+        (fh, download_path) = tempfile.mkstemp(dir=target_dir, prefix='.transfer-')
+        os.close(fh)
+        try:
+            xnat_file.download(download_path, verbose=False)
+            if postprocess:
+                postprocess(download_path, target_path)
+            else:
+                os.replace(download_path, target_path)
+        except Exception as err_msg:
+            slog.info(self.redcap_visit_id, "ERROR: failed to copy file from XNAT",
+                      uri=file_entry.get('URI'), target=target_path, err_msg=str(err_msg))
+            return False
+        finally:
+            if os.path.exists(download_path):
+                os.remove(download_path)
+
+        self._record(target_path, file_entry)
+        if self.verbose:
+            print("Copied", file_entry.get('URI'), "to", target_path)
+        return True
+
+    def finish(self):
+        """
+        Wait for all downloads and update the transfer log.
+
+        Returns - True if new files were created, False if not
+        """
+        self._executor.shutdown(wait=True)
+        files_created = False
+        for future in self._futures:
+            files_created = future.result() or files_created
+
+        if self._log_changed:
+            log_dir = os.path.dirname(self._log_path)
+            if not os.path.exists(log_dir):
+                os.makedirs(log_dir)
+            tmp_path = self._log_path + '.tmp'
+            with open(tmp_path, 'w') as log_file:
+                json.dump(self._log, log_file, indent=1, sort_keys=True)
+            os.replace(tmp_path, self._log_path)
+
+        return files_created
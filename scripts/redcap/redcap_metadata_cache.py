@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+##
+##  See COPYING file distributed along with the ncanda-data-integration package
+##  for the copyright and license terms
+##
+
+from __future__ import print_function
+import time
+
+
+class RedcapMetadataCache(object):
+    """
+    Cache of the metadata of a REDCap project (project info, data dictionary,
+    form-event mapping and the lookups derived from them), so that scripts
+    request each of them once per run rather than once per record.
+
+    Entries are fetched again once they are older than ttl seconds.
+
+    Example:
+        metadata_cache = RedcapMetadataCache(session.connect_server("data_entry", True))
+        project_id = metadata_cache.get_project_id()
+    """
+
+    def __init__(self, redcap_project, ttl=3600):
+        self.redcap_project = redcap_project
+        self.ttl = ttl
+        self._entries = dict()
+
+    def _get(self, key, fetch):
+        entry = self._entries.get(key)
+        if entry is None or time.time() - entry[0] > self.ttl:
+            entry = (time.time(), fetch())
+            self._entries[key] = entry
+        return entry[1]
+
+    def clear(self):
+        self._entries = dict()
+
+    def get_project_info(self):
+        return self._get("project_info", self.redcap_project.export_project_info)
+
+    def get_project_id(self):
+        return self.get_project_info()["project_id"]
+
+    def get_metadata(self):
+        """
+        Data dictionary as list of dicts, as in redcap.Project.metadata
+        """
+        return self._get(
+            "metadata", lambda: self.redcap_project.export_metadata(format="json")
+        )
+
+    def get_form_event_mapping(self):
+        """
+        Form-event mapping as pandas.DataFrame - callers must not modify it
+        """
+        return self._get(
+            "form_event_mapping",
+            lambda: self.redcap_project.export_fem(format="df"),
+        )
+
+    def get_field_names(self):
+        return self._get(
+            "field_names",
+            lambda: [field["field_name"] for field in self.get_metadata()],
+        )
+
+    def get_form_of_field(self, field_name, default=None):
+        """
+        Name of the form (instrument) the field is defined in
+        """
+        form_of_field = self._get(
+            "form_of_field",
+            lambda: {
+                field["field_name"]: field["form_name"]
+                for field in self.get_metadata()
+            },
+        )
+        return form_of_field.get(field_name, default)
+
+    def get_events_of_form(self, form_name, form_key="form"):
+        """
+        Unique names of the events that have the form. form_key is the name of
+        the form column of the form-event mapping (see
+        sibispy.Session.get_redcap_form_key)
+        """
+        events_of_form = self._get(
+            ("events_of_form", form_key),
+            lambda: self.get_form_event_mapping()
+            .groupby(form_key, sort=False)["unique_event_name"]
+            .apply(list)
+            .to_dict(),
+        )
+        return list(events_of_form.get(form_name, []))
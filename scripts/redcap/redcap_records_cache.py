@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+
+##
+##  See COPYING file distributed along with the ncanda-data-integration package
+##  for the copyright and license terms
+##
+
+from __future__ import print_function
+import io
+import re
+
+import pandas
+
+from sibispy import sibislogger as slog
+
+from redcap_metadata_cache import RedcapMetadataCache
+
+
+class RedcapRecordsCache(object):
+    """
+    Stand-in for a REDCap project (redcap.Project) that exports each form once
+    for a given set of records, in chunks of chunk_size records, and answers
+    export_records calls for some of those records from the exported forms.
+    Scripts that export the forms of one visit at a time (e.g.,
+    redcap_to_casesdir.export_subject_all_forms) thus make one request per
+    form and chunk rather than one per visit.
+
+    Only export_records(fields=..., records=..., events=..., event_name='unique',
+    format='df') is answered from the cache - all other calls and attributes
+    are passed on to the project. Forms are held as columns of strings, so that
+    the data types of the returned data frame are inferred from the requested
+    records only, as for a direct export.
+
+    Example:
+        records_cache = RedcapRecordsCache(redcap_project, ["A-00000-F-0"])
+        visit = records_cache.export_records(fields=["dob"], records=["A-00000-F-0"],
+                                             events=["baseline_visit_arm_1"],
+                                             event_name="unique", format="df")
+    """
+
+    def __init__(self, redcap_project, records, events=None, chunk_size=200, metadata_cache=None):
+        self._project = redcap_project
+        self._records = list(records)
+        self._record_set = set(self._records)
+        self._events = events
+        self._chunk_size = chunk_size
+        if metadata_cache is None:
+            metadata_cache = RedcapMetadataCache(redcap_project)
+        self._metadata_cache = metadata_cache
+        self._forms = dict()
+        self.hits = 0
+        self.misses = 0
+
+    def __getattr__(self, name):
+        return getattr(self._project, name)
+
+    def _get_index_columns(self):
+        return [self._project.def_field, "redcap_event_name"]
+
+    def _export_form(self, form_name):
+        chunks = []
+        for start in range(0, len(self._records), self._chunk_size):
+            chunks.append(
+                self._project.export_records(
+                    records=self._records[start : start + self._chunk_size],
+                    fields=[self._project.def_field],
+                    forms=[form_name],
+                    events=self._events,
+                    event_name="unique",
+                    format="df",
+                    df_kwargs={
+                        "index_col": self._get_index_columns(),
+                        "dtype": str,
+                        "keep_default_na": False,
+                    },
+                )
+            )
+        form_data = pandas.concat(chunks)
+
+        # Repeating instruments have more than one row per record and event
+        if not form_data.index.is_unique:
+            return None
+        return form_data
+
+    def _get_form(self, form_name):
+        if form_name not in self._forms:
+            try:
+                self._forms[form_name] = self._export_form(form_name)
+            except Exception as err_msg:
+                slog.info(
+                    "redcap_records_cache-" + form_name,
+                    "WARNING: Bulk export of form failed - its records are exported one by one",
+                    err_msg=str(err_msg),
+                )
+                self._forms[form_name] = None
+        return self._forms[form_name]
+
+    def _get_form_of_field(self, field_name):
+        form_name = self._metadata_cache.get_form_of_field(field_name)
+        if form_name is None:
+            match = re.match("^(.*)_complete$", field_name)
+            if match and match.group(1) in self._project.forms:
+                form_name = match.group(1)
+        return form_name
+
+    def _get_form_columns(self, form_data, fields):
+        # Checkbox fields are exported as one column per choice
+        return [
+            column
+            for column in form_data.columns
+            if column in fields or column.split("___")[0] in fields
+        ]
+
+    def _slice(self, fields, records, events):
+        """
+        Data frame of fields of the records and events - None if it cannot be
+        taken from the cache
+        """
+        if not set(records) <= self._record_set:
+            return None
+        if self._events is not None and (events is None or not set(events) <= set(self._events)):
+            return None
+
+        fields = set(fields) - {self._project.def_field}
+        form_names = []
+        for field_name in fields:
+            form_name = self._get_form_of_field(field_name)
+            if form_name is None:
+                return None
+            if form_name not in form_names:
+                form_names.append(form_name)
+        if not form_names:
+            return None
+
+        # Columns in the order of the data dictionary, as exported by REDCap
+        form_order = list(self._project.forms)
+        form_names.sort(key=lambda form_name: form_order.index(form_name) if form_name in form_order else len(form_order))
+
+        frames = []
+        for form_name in form_names:
+            form_data = self._get_form(form_name)
+            if form_data is None:
+                return None
+            rows = form_data.index.get_level_values(0).isin(records)
+            if events is not None:
+                rows &= form_data.index.get_level_values(1).isin(events)
+            frames.append(form_data.loc[rows, self._get_form_columns(form_data, fields)])
+
+        data = pandas.concat(frames, axis=1, sort=False)
+
+        # Parse the strings as a direct export would
+        return pandas.read_csv(io.StringIO(data.to_csv()), index_col=self._get_index_columns())
+
+    def export_records(self, records=None, fields=None, forms=None, events=None, format="json", **kwargs):
+        if (
+            format == "df"
+            and records
+            and fields
+            and not forms
+            and kwargs.get("event_name") == "unique"
+            and set(kwargs.keys()) <= {"event_name"}
+        ):
+            data = self._slice(fields, records, events)
+            if data is not None:
+                self.hits += 1
+                return data
+
+        self.misses += 1
+        return self._project.export_records(
+            records=records, fields=fields, forms=forms, events=events, format=format, **kwargs
+        )
@@ -13,6 +13,7 @@ import json
 import time
 import argparse
 import datetime
+import bisect
 from typing import Sequence
 import yaml
 import sys
@@ -21,6 +22,7 @@ import sibispy
 from sibispy import sibislogger as slog
 from sibispy import sibis_email, xnat_util
 from settings import XNAT_DATE_FORMAT
+from phantom_index import PhantomIndex
 
 
 #
@@ -42,6 +44,7 @@ def find_phantom_scan_24h(
     scanner,
     args,
     email,
+    phantom_index=None,
 ):
     # Compute the date before and after the experiment date
     today = datetime.datetime.today()
@@ -94,18 +97,23 @@ def find_phantom_scan_24h(
         ],
     ]
 
-    phantom_scans = list(
-        ifc.search(
-            "xnat:mrSessionData",
-            [
-                "xnat:mrSessionData/SESSION_ID",
-                "xnat:mrSessionData/DATE",
-                "xnat:mrSessionData/TIME",
-            ],
+    if phantom_index is not None:
+        phantom_scans = phantom_index.sessions_within(
+            edate, etime, PHANTOM_DAY_LIMIT, subject_id=phantom_id
+        )
+    else:
+        phantom_scans = list(
+            ifc.search(
+                "xnat:mrSessionData",
+                [
+                    "xnat:mrSessionData/SESSION_ID",
+                    "xnat:mrSessionData/DATE",
+                    "xnat:mrSessionData/TIME",
+                ],
+            )
+            .where(constraints)
+            .items()
         )
-        .where(constraints)
-        .items()
-    )
 
     # Still haven't found anything - then there is no phantom scan
     if (len(phantom_scans) == 0) and (today_str >= edate_tomorrow):
@@ -172,9 +180,13 @@ def find_phantom_scan_24h(
             )
         )
 
+    # Only a phantom within the limit that was not warned about counts as match
+    return len(phantom_scans) > 0 and not args.warn_same_day_phantom
+
 
-# Check one experiment for matching phantom scans
-def check_experiment(session, ifc, sibis_config, args, email, eid, xnat_url, experiment):
+# Check one experiment for matching phantom scans - returns True if a matching
+# phantom scan was found (or none is needed)
+def check_experiment(session, ifc, sibis_config, args, email, eid, xnat_url, experiment, phantom_index=None):
     expUtil = xnat_util.XNATSessionElementUtil(experiment)
     try:
         experiment_last_modified = expUtil.get("last_modified")
@@ -240,22 +252,28 @@ def check_experiment(session, ifc, sibis_config, args, email, eid, xnat_url, exp
                 )
                 return False
 
-            try:
-                phantom_scans = ifc.array.experiments(experiment_type='xnat:mrSessionData', constraints={ 'xnat:mrSessionData/subject_id':phantom_id, 'date': edate})
-            except Exception as e:
-                error=f"Failed to retrieve phantom scan with id {phantom_id} on {edate}."
-                slog.info(experiment_label,error,
-                          site_id=sid,
-                          project=prj,
-                          subject_experiment_id=seid,
-                          error_msg = str(e) )
-                return False
+            if phantom_index is not None:
+                phantom_scans = phantom_index.sessions_on_date(edate, subject_id=phantom_id)
+                eids = [eid for (eid, phantom_scanner) in phantom_scans]
+                phantom_scanners = [phantom_scanner for (eid, phantom_scanner) in phantom_scans]
+            else:
+                try:
+                    phantom_scans = ifc.array.experiments(experiment_type='xnat:mrSessionData', constraints={ 'xnat:mrSessionData/subject_id':phantom_id, 'date': edate})
+                except Exception as e:
+                    error=f"Failed to retrieve phantom scan with id {phantom_id} on {edate}."
+                    slog.info(experiment_label,error,
+                              site_id=sid,
+                              project=prj,
+                              subject_experiment_id=seid,
+                              error_msg = str(e) )
+                    return False
+
+                eids = phantom_scans.get("ID", always_list=True)
+                phantom_scanners = [
+                    ifc.select.experiments[eid].get("scanner") for eid in eids
+                ]
 
             # handle check for phantoms on the same day but wrong scanner
-            eids = phantom_scans.get("ID", always_list=True)
-            phantom_scanners = [
-                ifc.select.experiments[eid].get("scanner") for eid in eids
-            ]
             if args.verbose:
                 print("Phantom scans: {0}".format(phantom_scans))
                 
@@ -272,8 +290,9 @@ def check_experiment(session, ifc, sibis_config, args, email, eid, xnat_url, exp
                     xnat_url=xnat_url,
                     project=prj,
                 )
+                return False
             elif len(phantom_scans) == 0:
-                find_phantom_scan_24h(
+                return find_phantom_scan_24h(
                     prj,
                     experiment_label,
                     seid,
@@ -285,6 +304,7 @@ def check_experiment(session, ifc, sibis_config, args, email, eid, xnat_url, exp
                     scanner,
                     args,
                     email,
+                    phantom_index,
                 )
         except IndexError as e:
             error = "ERROR: Subject likely switched sites if site_id > NCANDA_S01010"
@@ -299,6 +319,95 @@ def check_experiment(session, ifc, sibis_config, args, email, eid, xnat_url, exp
                 info="Most likely entry missing for this visit in section 'check_phantom_scans' of file 'special_cases.yml'",
                 error_msg=str(e),
             )
+            return False
+
+    return True
+
+
+def _load_state(state_file: str) -> dict:
+    """
+    Load phantom-match results of the previous incremental run.
+    """
+    if not os.path.exists(state_file):
+        return dict()
+
+    with open(state_file, "r") as fi:
+        return json.load(fi)
+
+
+def _save_state(state_file: str, state: dict) -> None:
+    """
+    Store phantom-match results so that the next run only re-checks what changed.
+    """
+    tmp_file = state_file + ".tmp"
+    with open(tmp_file, "w") as fi:
+        json.dump(state, fi, indent=1, sort_keys=True)
+    os.replace(tmp_file, state_file)
+
+
+def _get_mr_sessions(ifc) -> dict:
+    """
+    Retrieve subject, date and last modification of all MR sessions with a
+    single search.
+    """
+    fields = [
+        "xnat:mrSessionData/SESSION_ID",
+        "xnat:mrSessionData/SUBJECT_ID",
+        "xnat:mrSessionData/DATE",
+        "xnat:mrSessionData/INSERT_DATE",
+        "xnat:mrSessionData/LAST_MODIFIED",
+    ]
+    criteria = [("xnat:mrSessionData/SESSION_ID", "LIKE", "%")]
+    mr_sessions = dict()
+    for eid, sid, edate, insert_date, last_modified in (
+        ifc.search("xnat:mrSessionData", fields).where(criteria).items()
+    ):
+        mr_sessions[eid] = {
+            "subject": sid,
+            "date": edate,
+            "last_modified": last_modified or insert_date,
+        }
+    return mr_sessions
+
+
+def _get_experiments_to_recheck(
+    mr_sessions: dict, state: dict, phantom_ids: Sequence[str]
+) -> list:
+    """
+    Select sessions that are new, were modified, or have a new or modified
+    phantom session within PHANTOM_DAY_LIMIT days. Sessions that did not match
+    a phantom are re-checked on the same terms, as only a change of the session
+    or of a phantom nearby can change their result.
+    """
+    changed = [
+        eid
+        for eid, info in mr_sessions.items()
+        if eid not in state
+        or state[eid]["last_modified"] != info["last_modified"]
+    ]
+
+    changed_phantom_days = sorted(
+        datetime.datetime.strptime(mr_sessions[eid]["date"], "%Y-%m-%d").toordinal()
+        for eid in changed
+        if mr_sessions[eid]["subject"] in phantom_ids and mr_sessions[eid]["date"]
+    )
+
+    def _near_changed_phantom(edate: str) -> bool:
+        if not edate or not changed_phantom_days:
+            return False
+        day = datetime.datetime.strptime(edate, "%Y-%m-%d").toordinal()
+        index = bisect.bisect_left(changed_phantom_days, day - PHANTOM_DAY_LIMIT)
+        return (
+            index < len(changed_phantom_days)
+            and changed_phantom_days[index] <= day + PHANTOM_DAY_LIMIT
+        )
+
+    changed = set(changed)
+    return [
+        eid
+        for eid, info in sorted(mr_sessions.items())
+        if eid in changed or _near_changed_phantom(info["date"])
+    ]
 
 
 def _parse_args(input_args: Sequence[str] = None) -> argparse.Namespace:
@@ -338,6 +447,16 @@ def _parse_args(input_args: Sequence[str] = None) -> argparse.Namespace:
         default=False,
         help="Check only session indicated, regardless of modification date.",
     )
+    parser.add_argument(
+        "-i",
+        "--incremental",
+        action="store_true",
+        dest="incremental",
+        default=False,
+        help="Only re-check MR sessions that are new or changed since the last "
+        "incremental run, or have a new or changed phantom session within the "
+        "day limit.",
+    )
     parser.add_argument(
         "-v",
         "--verbose",
@@ -434,11 +553,37 @@ if __name__ == "__main__":
     except:
         pass
 
+    # All phantom sessions - loaded once instead of searching them per session
+    phantom_index = PhantomIndex.from_xnat(ifc)
+
     experiment_ids = list()
     count_phantom = 0
 
+    # Phantom-match results of previous incremental run
+    state = dict()
+    state_file = os.path.join(session.get_log_dir(), "check_phantom_scans_state.json")
+
     if args.eid:
         experiment_ids.append(args.eid)
+    elif args.incremental:
+        mr_sessions = _get_mr_sessions(ifc)
+        state = _load_state(state_file)
+        # Drop sessions that no longer exist
+        state = {eid: state[eid] for eid in state if eid in mr_sessions}
+
+        criteria = [("xnat:subjectData/SUBJECT_LABEL", "LIKE", "%-99999-P-9")]
+        phantom_ids = set(
+            ifc.search("xnat:subjectData", ["xnat:subjectData/SUBJECT_ID"])
+            .where(criteria)
+            .get("subject_id")
+        )
+        experiment_ids = _get_experiments_to_recheck(mr_sessions, state, phantom_ids)
+        if args.verbose:
+            print(
+                "Re-checking {} of {} MR sessions".format(
+                    len(experiment_ids), len(mr_sessions)
+                )
+            )
     else:
         # Get a list of all MR imaging sessions
         experiment_ids = list(ifc.select.experiments)
@@ -457,12 +602,28 @@ if __name__ == "__main__":
                 xnat_url=xnat_url,
                 error_msg=str(e),
             )
+            # Not retried until the session is modified (or run with -e)
+            if args.incremental and not args.eid:
+                state[eid] = {
+                    "last_modified": mr_sessions[eid]["last_modified"],
+                    "ok": False,
+                }
             continue
 
         # Do not change to True ! as xnat saves it as 'true'
+        phantom_ok = True
         if experiment.fields.get("phantommissingoverride") != "true":
             count_phantom += 1
-            check_experiment(session, ifc, sibis_config, args, email, eid, xnat_url, experiment)
+            phantom_ok = check_experiment(session, ifc, sibis_config, args, email, eid, xnat_url, experiment, phantom_index)
+
+        if args.incremental and not args.eid:
+            state[eid] = {
+                "last_modified": mr_sessions[eid]["last_modified"],
+                "ok": bool(phantom_ok),
+            }
+
+    if args.incremental and not args.eid:
+        _save_state(state_file, state)
 
     if args.sendmail:
         email.send_all(ifc)
@@ -15,20 +15,141 @@ import numpy
 import re
 import time 
 import sys 
+import traceback
+import sqlite3
+import hashlib
+import json
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 from sibispy import sibislogger as slog
 from sibispy import utils as sutils
 from sibispy.xnat_util import XNATSessionElementUtil, XNATResourceUtil, XNATExperimentUtil
 
 #
-# Export experiment files to NIFTI
+# Local index of the dicom files that the nifti files of each scan were created from
+# 
+# For every experiment/scan the number, total size and a digest of the dicom files are
+# stored together with the modification time of the dicom directory and the names of the
+# created nifti files. The digest covers name, size and modification time of each file as
+# well as its first and last block (SAMPLE_SIZE bytes each), so that a file rewritten with
+# the same size is noticed. A scan is up to date if listing the dicom directory gives the
+# same number of files and directory modification time as stored. Only otherwise is every
+# dicom file looked at to compute the digest.
 #
-def export_to_nifti(experiment, subject, session, session_label, scan, scantype, xnat_dir, verbose=False):
-    if verbose:
-        print("Start export of nifti files for ", subject, session, session_label, scan, scantype,xnat_dir)
+class NiftiIndex(object):
+    CURRENT = 'current'
+    CHANGED = 'changed'
+    UNKNOWN = 'unknown'
 
-    error_msg = []
+    # Bytes read from the start and the end of each dicom file for the digest
+    SAMPLE_SIZE = 4096
+    # Prefix of digests that include content samples - older ones only cover file metadata
+    DIGEST_VERSION = 'v2:'
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._connection = None
+        self._pid = None
+        # signature of dicom files computed by check() until the scan was converted
+        self._pending = dict()
+
+    def _connect(self):
+        # sqlite connections cannot be shared with forked processes
+        if self._pid != os.getpid():
+            self._connection = sqlite3.connect(self.db_path, timeout=60, check_same_thread=False)
+            self._connection.execute('CREATE TABLE IF NOT EXISTS nifti_index ('
+                                     'experiment TEXT, scan TEXT, dicom_count INTEGER, dicom_size INTEGER, '
+                                     'dicom_digest TEXT, outputs TEXT, updated TEXT, dicom_dir_mtime INTEGER, '
+                                     'PRIMARY KEY (experiment, scan))')
+            # Indices written before the directory modification time was stored
+            columns = [column[1] for column in self._connection.execute('PRAGMA table_info(nifti_index)')]
+            if 'dicom_dir_mtime' not in columns:
+                self._connection.execute('ALTER TABLE nifti_index ADD COLUMN dicom_dir_mtime INTEGER')
+            self._connection.commit()
+            self._pid = os.getpid()
+        return self._connection
+
+    @staticmethod
+    def list_dicoms(dicom_path):
+        # ommit xml file as it is updated every time somebody changes something in the gui for that session
+        # (is_file() is answered by the directory listing itself, no file is stat'ed)
+        return sorted((entry for entry in os.scandir(dicom_path) if '.xml' not in entry.name and entry.is_file()),
+                      key=lambda entry: entry.name)
+
+    @classmethod
+    def dicom_signature(cls, entries):
+        count = 0
+        size = 0
+        digest = hashlib.sha1()
+        for entry in entries:
+            stat = entry.stat()
+            count += 1
+            size += stat.st_size
+            digest.update(('%s:%d:%d\n' % (entry.name, stat.st_size, stat.st_mtime_ns)).encode())
+            with open(entry.path, 'rb') as dicom_file:
+                digest.update(dicom_file.read(cls.SAMPLE_SIZE))
+                if stat.st_size > cls.SAMPLE_SIZE:
+                    dicom_file.seek(max(cls.SAMPLE_SIZE, stat.st_size - cls.SAMPLE_SIZE))
+                    digest.update(dicom_file.read(cls.SAMPLE_SIZE))
+
+        return count, size, cls.DIGEST_VERSION + digest.hexdigest()
+
+    def check(self, experiment, scan, dicom_path, nifti_log):
+        dir_mtime = os.stat(dicom_path).st_mtime_ns
+        entries = self.list_dicoms(dicom_path)
+        with self._lock:
+            row = self._connect().execute('SELECT dicom_count, dicom_size, dicom_digest, dicom_dir_mtime FROM nifti_index '
+                                          'WHERE experiment = ? AND scan = ?', (experiment, str(scan))).fetchone()
+
+        # Fast path - no file was added, removed or renamed since the scan was converted
+        if row is not None and entries and row[0] == len(entries) and row[3] == dir_mtime \
+                and os.path.exists(nifti_log):
+            return self.CURRENT
+
+        signature = self.dicom_signature(entries)
+        with self._lock:
+            self._pending[(experiment, scan)] = signature + (dir_mtime,)
+
+        # without dicom or nifti files leave it to the caller to figure out what is going on -
+        # as for scans indexed before digests included content samples
+        if row is None or signature[0] == 0 or not os.path.exists(nifti_log) \
+                or not str(row[2]).startswith(self.DIGEST_VERSION):
+            return self.UNKNOWN
 
+        if tuple(row[:3]) == signature:
+            # Only the directory changed - store its new time so that the next check is fast again
+            with self._lock:
+                self._pending.pop((experiment, scan), None)
+                connection = self._connect()
+                connection.execute('UPDATE nifti_index SET dicom_dir_mtime = ? WHERE experiment = ? AND scan = ?',
+                                   (dir_mtime, experiment, str(scan)))
+                connection.commit()
+            return self.CURRENT
+
+        return self.CHANGED
+
+    def mark_converted(self, experiment, scan, outputs):
+        with self._lock:
+            signature = self._pending.pop((experiment, scan), None)
+            if signature is None:
+                return
+
+            (count, size, digest, dir_mtime) = signature
+            connection = self._connect()
+            connection.execute('INSERT OR REPLACE INTO nifti_index (experiment, scan, dicom_count, dicom_size, '
+                               'dicom_digest, outputs, updated, dicom_dir_mtime) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                               (experiment, str(scan), count, size, digest, json.dumps(outputs),
+                                time.strftime('%Y-%m-%d %H:%M:%S'), dir_mtime))
+            connection.commit()
+
+#
+# Find dicom files of scan and check if nifti files need to be (re)created
+# Returns path to dicom files or None if there is nothing to do
+#
+def _get_dicom_path(experiment, subject, session, session_label, scan, scantype, xnat_dir, error_msg, nifti_index=None, verbose=False):
     # logfile_resource = '%s_%s/dcm2image.log' % (scan, scantype)
     # xnat_log = interface.select.project(project).subject(subject).experiment(session).resource('nifti').file(logfile_resource)
     # To test gradient directions without having to delete nifti files in xnat just uncomment this line 
@@ -38,7 +159,7 @@ def export_to_nifti(experiment, subject, session, session_label, scan, scantype,
     match = re.match('.*('+ xnat_dir + '/.*)scan_.*_catalog.xml.*',XNATSessionElementUtil(experiment.scans[scan]).xml,re.DOTALL)
     if not match:
         error_msg.append("XNAT scan info fails to contain catalog.xml location! SID:""%s EID:%s Label: %s SCAN: %s" % (subject, session,session_label,scan))
-        return error_msg,0
+        return None
 
     dicom_path = match.group(1)
     if not os.path.exists(dicom_path):
@@ -46,10 +167,27 @@ def export_to_nifti(experiment, subject, session, session_label, scan, scantype,
         dicom_path = re.sub('storage/XNAT', 'ncanda-xnat', dicom_path)
         if not os.path.exists(dicom_path):
             error_msg.append("Path %s does not exist - export_to_nifti failed for SID:%s EID:%s Label: %s!" % (dicom_path, subject, session,session_label))
-            return error_msg,0
+            return None
 
+    nifti_log = re.sub('/DICOM/','_%s/dcm2image.log' % (scantype),re.sub( '/SCANS/', '/RESOURCES/nifti/', dicom_path))
+
+    # Compare dicom files with the ones the nifti files were created from 
+    if nifti_index is not None:
+        state = nifti_index.check(session, scan, dicom_path, nifti_log)
+        if state == NiftiIndex.CURRENT:
+            if verbose:
+                print("... nothing to do as nifti files are up to date")
+            return None
+
+        if state == NiftiIndex.CHANGED:
+            slog.info(session_label + "_" + scan, "Warning: dicom files changed since nifti files were created so they are recreated!",
+                      session=session,
+                      subject=subject,
+                      check_nifti = nifti_log,
+                      check_dicom = dicom_path)
+            return dicom_path
 
-    nifti_log_search = glob.glob(re.sub('/DICOM/','_%s/dcm2image.log' % (scantype),re.sub( '/SCANS/', '/RESOURCES/nifti/', dicom_path)))
+    nifti_log_search = glob.glob(nifti_log)
 
     # if nifti files were created make sure that they are newer than dicom file otherwise recreate them  
     if  nifti_log_search != [] :
@@ -67,17 +205,21 @@ def export_to_nifti(experiment, subject, session, session_label, scan, scantype,
                       scan_number=scan,
                       scan_type=scantype,
                       dicom_log_file=dicom_file_pattern)
-            return error_msg,0
+            return None
 
         # check time stamp - if newer than there is nothing to do
-        nifti_time = time.strftime('%Y-%m-%d %H:%m:%S',time.gmtime(os.path.getmtime(nifti_log_search[0])))
-        dicom_time = time.strftime('%Y-%m-%d %H:%m:%S',time.gmtime(os.path.getmtime(dicom_file_list[0])))
+        nifti_mtime = os.path.getmtime(nifti_log_search[0])
+        dicom_mtime = os.path.getmtime(dicom_file_list[0])
+        nifti_time = time.strftime('%Y-%m-%d %H:%M:%S',time.gmtime(nifti_mtime))
+        dicom_time = time.strftime('%Y-%m-%d %H:%M:%S',time.gmtime(dicom_mtime))
 
-        if nifti_time > dicom_time  :
+        if nifti_mtime > dicom_mtime  :
             if verbose:
                 print("... nothing to do as nifti files are up to date")
-            return error_msg,0
-
+            # Scan was converted before the index existed
+            if nifti_index is not None:
+                nifti_index.mark_converted(session, scan, sorted(os.listdir(os.path.dirname(nifti_log))))
+            return None
 
         slog.info(session_label + "_" + scan, "Warning: nifti seem outdated (dicom > nifti time) so they are recreated!", 
                   session=session,
@@ -86,10 +228,13 @@ def export_to_nifti(experiment, subject, session, session_label, scan, scantype,
                   check_dicom = str(dicom_time) + " " + str(dicom_file_list[0]),
                   info =  "If the issue reappears then simply open up the session in  XNAT, go to 'Manage Files', delete the directory 'Resources/nifti/" + scantype + "'. If the pop-up window does not say that it is deleting 'dicom.log' then most likely you will have to manually delete the directory from the hard drive. To find out, simply run the script again. If the error message still reappears then repeat the previous procedure and afterwards delete the directory that the log file in check_nifti is located!")
 
+    return dicom_path
 
-    #
-    # Turn dicoms into niftis 
-    #
+#
+# Turn dicoms into niftis 
+# Returns temporary directory and names of the created files or None if it failed
+#
+def _convert_to_nifti(scan, scantype, dicom_path, error_msg):
     temp_dir = tempfile.mkdtemp()
 
     args = '--tolerance 1e-3 --write-single-slices --no-progress -rvxO %s/%s_%s/image%%n.nii %s 2>&1' % (temp_dir, scan, scantype, dicom_path)
@@ -98,7 +243,7 @@ def export_to_nifti(experiment, subject, session, session_label, scan, scantype,
         error_msg.append("The following command failed: %s" % (sutils.dcm2image_cmd + args + " ! msg : " + str(eout)))
         # Clean up - remove temp directory
         shutil.rmtree(temp_dir)
-        return error_msg,0
+        return None
 
     # Needed as we check for dcm2image.log when rerunning the case - should come up with better mechanism
     log_filename = '%s/%s_%s/dcm2image.log' % (temp_dir, scan, scantype)
@@ -108,44 +253,247 @@ def export_to_nifti(experiment, subject, session, session_label, scan, scantype,
     finally:
         output_file.close()
 
-    # Zipping directory with nifti files
+    outputs = [os.path.basename(src) for src in sorted(glob.glob('%s/*/*' % temp_dir))]
+    return temp_dir, outputs
+
+def _zip_compression(compression_level):
+    if compression_level:
+        return zipfile.ZIP_DEFLATED, compression_level
+    return zipfile.ZIP_STORED, None
+
+#
+# Zipping directory with nifti files on disk
+# Returns path to the zip file or None if it failed
+#
+def _zip_nifti(scan, scantype, temp_dir, error_msg, compression_level=0):
     zip_file_name = '%s_%s.zip' % (scan, scantype)
     zip_path = '%s/%s' % (temp_dir, zip_file_name)
-    
+    (compression, compresslevel) = _zip_compression(compression_level)
     try:
-        fzip = zipfile.ZipFile(zip_path, 'w')
+        fzip = zipfile.ZipFile(zip_path, 'w', compression, compresslevel=compresslevel)
         for src in sorted(glob.glob('%s/*/*' % temp_dir)):
             fzip.write(src, re.sub('%s/' % temp_dir, '', src))
         fzip.close()
     except Exception as e:
         error_msg.append("Could not zip %s - err_msg: %s" % (zip_path,str(e)))
-        # Clean up - remove temp directory
-        shutil.rmtree(temp_dir)
-        return error_msg,0
+        return None
 
     if not os.path.exists(zip_path):
         error_msg.append("Could not zip %s - does not exists !" % (zip_path))
-        # Clean up - remove temp directory
-        shutil.rmtree(temp_dir)
-        return error_msg,0
+        return None
+
+    return zip_path
+
+#
+# Collects what zipfile writes so that it can be handed on in chunks
+#
+class _ZipChunks(object):
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
 
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+#
+# Generate the zip archive of the nifti files one file at a time 
+#
+def _generate_nifti_zip(temp_dir, compression_level=0):
+    chunks = _ZipChunks()
+    (compression, compresslevel) = _zip_compression(compression_level)
+    with zipfile.ZipFile(chunks, 'w', compression, compresslevel=compresslevel) as fzip:
+        for src in sorted(glob.glob('%s/*/*' % temp_dir)):
+            fzip.write(src, re.sub('%s/' % temp_dir, '', src))
+            data = chunks.pop()
+            if data:
+                yield data
+
+    yield chunks.pop()
+
+#
+# Stream the zip archive directly into the body of the upload request
+# Returns None if the server does not accept chunked uploads 
+#
+def _stream_nifti_zip(xnat_http, xnat_data_address, session, scan, scantype, temp_dir, error_msg, compression_level=0):
+    zip_file_name = '%s_%s.zip' % (scan, scantype)
+    uri = '%s/experiments/%s/resources/nifti/files/%s' % (xnat_data_address, session, zip_file_name)
+    response = xnat_http.put(uri,
+                             params={'inbody': 'true', 'extract': 'true', 'overwrite': 'true'},
+                             data=_generate_nifti_zip(temp_dir, compression_level),
+                             headers={'content-type': 'application/zip'})
+    # Length Required / Not Implemented 
+    if response.status_code in (411, 501):
+        return None
+
+    if not response.ok:
+        error_msg.append("Unable to upload ZIP file %s to experiment %s (status %d)" % (zip_file_name, session, response.status_code))
+        return False
+
+    return True
+
+#
+# Upload nifti files to nifti resource of experiment and remove temporary directory
+# Zip file is streamed to the server if xnat_http is defined - otherwise (or if the server
+# rejects it) it is written to disk first 
+#
+def _upload_nifti(experiment, session, scan, scantype, temp_dir, error_msg, xnat_http=None, xnat_data_address=None, compression_level=0):
+    zip_file_name = '%s_%s.zip' % (scan, scantype)
+    zip_path = None
     try: 
         exp_util=XNATExperimentUtil(experiment) 
         resource=exp_util.resources_insure('nifti')
+
+        if xnat_http is not None:
+            uploaded = _stream_nifti_zip(xnat_http, xnat_data_address, session, scan, scantype, temp_dir, error_msg, compression_level)
+            if uploaded is not None:
+                return uploaded
+
+        zip_path = _zip_nifti(scan, scantype, temp_dir, error_msg, compression_level)
+        if not zip_path:
+            return False
+
         resource_util = XNATResourceUtil(resource)
         resource_util.detailed_upload(zip_path, zip_file_name, extract=True, overwrite=True)
 
     except Exception as e:
-        error_msg.append("Unable to upload ZIP file %s to experiment %s" % (zip_path, session))
+        error_msg.append("Unable to upload ZIP file %s to experiment %s" % (zip_path or zip_file_name, session))
         print("ERROR",str(e))
         print("DEBUG",error_msg) 
-        exit(0)
-        # Clean up - remove temp directory
-        shutil.rmtree(temp_dir)
-        return error_msg,0
+        return False
 
+    finally:
+        # Clean up - remove temp directory
+        shutil.rmtree(temp_dir, ignore_errors=True)
 
     # Verify image counts for various series
     # images_created = len(glob.glob('%s/*/*.nii.gz' % temp_dir))
-    shutil.rmtree(temp_dir)
+    return True
+
+#
+# Export experiment files to NIFTI
+#
+def export_to_nifti(experiment, subject, session, session_label, scan, scantype, xnat_dir, nifti_index=None, xnat_http=None, xnat_data_address=None, compression_level=0, verbose=False):
+    if verbose:
+        print("Start export of nifti files for ", subject, session, session_label, scan, scantype,xnat_dir)
+
+    error_msg = []
+
+    dicom_path = _get_dicom_path(experiment, subject, session, session_label, scan, scantype, xnat_dir, error_msg, nifti_index, verbose)
+    if not dicom_path:
+        return error_msg,0
+
+    nifti_result = _convert_to_nifti(scan, scantype, dicom_path, error_msg)
+    if not nifti_result:
+        return error_msg,0
+
+    (temp_dir, outputs) = nifti_result
+    if not _upload_nifti(experiment, session, scan, scantype, temp_dir, error_msg, xnat_http, xnat_data_address, compression_level):
+        return error_msg,0
+
+    if nifti_index is not None:
+        nifti_index.mark_converted(session, scan, outputs)
+
     return error_msg,1
+
+#
+# Export all scans of an experiment to NIFTI 
+# 
+# scan_list is a list of (scan, scantype) pairs. Conversions run in up to max_jobs parallel
+# dcm2image processes, while finished conversions are uploaded one at a time in the background.
+# At most max_jobs converted scans wait for their upload so that local disk use stays bounded.
+# Returns a list of (error_msg, niftisWereCreatedFlag) in the same order as scan_list, i.e. the
+# same per scan result as export_to_nifti 
+#
+def export_scans_to_nifti(experiment, subject, session, session_label, scan_list, xnat_dir, max_jobs=4, nifti_index=None, xnat_http=None, xnat_data_address=None, compression_level=0, verbose=False):
+    error_msgs = [[] for _ in scan_list]
+    dicom_paths = []
+    max_jobs = max(1, max_jobs)
+
+    # Checking scans requires XNAT so it is done before any conversion is started
+    for index, (scan, scantype) in enumerate(scan_list):
+        if verbose:
+            print("Start export of nifti files for ", subject, session, session_label, scan, scantype,xnat_dir)
+        try:
+            dicom_path = _get_dicom_path(experiment, subject, session, session_label, scan, scantype, xnat_dir, error_msgs[index], nifti_index, verbose)
+        except Exception as e:
+            error_msgs[index].append(_format_exception(scan, scantype, e))
+            dicom_path = None
+        dicom_paths.append(dicom_path)
+
+    # Acquired before a conversion is started and released once the temporary directory
+    # of the scan is removed
+    temp_dir_slots = threading.BoundedSemaphore(max_jobs)
+
+    def convert(index):
+        (scan, scantype) = scan_list[index]
+        try:
+            nifti_result = _convert_to_nifti(scan, scantype, dicom_paths[index], error_msgs[index])
+        except Exception as e:
+            error_msgs[index].append(_format_exception(scan, scantype, e))
+            nifti_result = None
+        if not nifti_result:
+            temp_dir_slots.release()
+        return nifti_result
+
+    def upload(index, nifti_result):
+        (scan, scantype) = scan_list[index]
+        (temp_dir, outputs) = nifti_result
+        try:
+            if not _upload_nifti(experiment, session, scan, scantype, temp_dir, error_msgs[index], xnat_http, xnat_data_address, compression_level):
+                return False
+            if nifti_index is not None:
+                nifti_index.mark_converted(session, scan, outputs)
+            return True
+        except Exception as e:
+            error_msgs[index].append(_format_exception(scan, scantype, e))
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            return False
+        finally:
+            temp_dir_slots.release()
+
+    to_convert = [index for index, dicom_path in enumerate(dicom_paths) if dicom_path]
+    conversions = deque()
+    uploads = []
+
+    def hand_on_oldest_conversion():
+        (index, conversion) = conversions.popleft()
+        nifti_result = conversion.result()
+        if nifti_result:
+            uploads.append((index, upload_pool.submit(upload, index, nifti_result)))
+
+    # Only one upload at a time so that the experiment is never accessed concurrently
+    with ThreadPoolExecutor(max_workers=max_jobs) as convert_pool, \
+         ThreadPoolExecutor(max_workers=1) as upload_pool:
+        for index in to_convert:
+            # Wait for a free slot - meanwhile hand finished conversions on to the upload
+            while not temp_dir_slots.acquire(blocking=False):
+                if conversions:
+                    hand_on_oldest_conversion()
+                else:
+                    temp_dir_slots.acquire()
+                    break
+            conversions.append((index, convert_pool.submit(convert, index)))
+
+        while conversions:
+            hand_on_oldest_conversion()
+
+        created = [False] * len(scan_list)
+        for index, uploaded in uploads:
+            created[index] = uploaded.result()
+
+    return [(error_msg, int(flag)) for error_msg, flag in zip(error_msgs, created)]
+
+def _format_exception(scan, scantype, e):
+    err_msg = str(e)
+    if len(err_msg) == 0:
+        err_msg = "No specific error msg!"
+
+    return "Exporting %s_%s failed: %s - %s" % (scan, scantype, err_msg, traceback.format_exc())
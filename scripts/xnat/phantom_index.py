@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+##
+##  See COPYING file distributed along with the ncanda-data-integration package
+##  for the copyright and license terms
+##
+
+from __future__ import print_function
+import bisect
+import datetime
+from collections import defaultdict
+
+# Phantom subjects are labeled <site>-99999-P-9 (ADNI) and <site>-00000-P-0 (fBIRN)
+PHANTOM_SESSION_LABELS = ["%-99999-P-9-%", "%-00000-P-0-%"]
+
+PHANTOM_SESSION_FIELDS = [
+    "xnat:mrSessionData/SESSION_ID",
+    "xnat:mrSessionData/SUBJECT_ID",
+    "xnat:mrSessionData/SCANNER",
+    "xnat:mrSessionData/DATE",
+    "xnat:mrSessionData/TIME",
+]
+
+
+def _to_datetime(date, time=None):
+    try:
+        return datetime.datetime.strptime(
+            "%s %s" % (date, time or "00:00:00"), "%Y-%m-%d %H:%M:%S"
+        )
+    except ValueError:
+        return datetime.datetime.strptime(date, "%Y-%m-%d")
+
+
+class PhantomIndex(object):
+    """
+    All phantom sessions sorted by date and time, grouped per scanner and per
+    phantom subject, so that phantoms near a session are found by binary search.
+    """
+
+    def __init__(self, phantom_sessions):
+        """
+        phantom_sessions: (eid, subject_id, scanner, date, time) tuples - time
+        can be None. Sessions of the same date keep the order they are given in.
+        """
+        self._by_group = defaultdict(list)
+        for order, (eid, subject_id, scanner, date, time) in enumerate(
+            phantom_sessions
+        ):
+            if not date:
+                continue
+            entry = (_to_datetime(date, time), order, eid, scanner)
+            self._by_group[("scanner", scanner)].append(entry)
+            self._by_group[("subject", subject_id)].append(entry)
+
+        self._keys = dict()
+        for group, entries in self._by_group.items():
+            entries.sort()
+            self._keys[group] = [entry[0] for entry in entries]
+
+    @classmethod
+    def from_xnat(cls, ifc):
+        """
+        Load all ADNI and fBIRN phantom sessions with a single search.
+        """
+        criteria = [
+            ("xnat:mrSessionData/LABEL", "LIKE", label)
+            for label in PHANTOM_SESSION_LABELS
+        ] + ["OR"]
+        return cls(
+            ifc.search("xnat:mrSessionData", PHANTOM_SESSION_FIELDS)
+            .where(criteria)
+            .items()
+        )
+
+    def _group(self, scanner, subject_id):
+        if subject_id is not None:
+            return ("subject", subject_id)
+        return ("scanner", scanner)
+
+    def _entries_between(self, group, start, end):
+        keys = self._keys.get(group, [])
+        entries = self._by_group.get(group, [])
+        return entries[bisect.bisect_left(keys, start) : bisect.bisect_right(keys, end)]
+
+    def sessions_on_date(self, date, scanner=None, subject_id=None):
+        """
+        (eid, scanner) of all phantom sessions on the given date.
+        """
+        day = _to_datetime(date)
+        entries = self._entries_between(
+            self._group(scanner, subject_id),
+            day,
+            day + datetime.timedelta(days=1, microseconds=-1),
+        )
+        return [(eid, sscanner) for (_, _, eid, sscanner) in entries]
+
+    def sessions_within(self, date, time=None, days=1, scanner=None, subject_id=None):
+        """
+        (eid, scanner) of all phantom sessions within +/- days of the given date
+        and time, nearest first.
+        """
+        center = _to_datetime(date, time)
+        delta = datetime.timedelta(days=days)
+        entries = self._entries_between(
+            self._group(scanner, subject_id), center - delta, center + delta
+        )
+        entries = sorted(entries, key=lambda entry: (abs(entry[0] - center), entry[1]))
+        return [(eid, sscanner) for (_, _, eid, sscanner) in entries]
+
+    def nearest(self, date, time=None, days=1, scanner=None, subject_id=None):
+        """
+        eid of the phantom session nearest to the given date and time within
+        +/- days, or None.
+        """
+        sessions = self.sessions_within(date, time, days, scanner, subject_id)
+        if sessions:
+            return sessions[0][0]
+        return None
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+##
+##  See COPYING file distributed along with the ncanda-data-integration package
+##  for the copyright and license terms
+##
+
+import io
+import os
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../../scripts/qc/'))
+from make_redcap_inventory import get_form_stats
+from qa_utils import get_items_matching_regex
+
+
+# Former row-by-row computation that get_form_stats replaces, applied with
+# form_data.apply(get_flag_and_meta, axis=1)
+def get_flag_and_meta(row: pd.Series) -> pd.Series:
+    columns = row.index.tolist()
+
+    cols_dag = get_items_matching_regex('redcap_data_access_group', columns)
+    cols_complete = get_items_matching_regex(
+        "_complete$|^np_reyo_qc___completed$", columns)
+    cols_ignore = get_items_matching_regex(
+        "^visit_ignore___yes$|_exclude$|^np_gpeg_exclusion", columns)
+    cols_missing = get_items_matching_regex(
+        "^bio_mr_same_as_np___yes$|_missing$", columns)
+    cols_missing_explanation = get_items_matching_regex(
+        "_missing_why(_other)?$", columns)
+    cols_checklists = get_items_matching_regex('___', columns)
+
+    cols_checklists_pure = (set(cols_checklists)
+                            - set(cols_ignore)
+                            - set(cols_complete)
+                            - set(cols_missing))
+    cols_checklists_pure = [c for c in cols_checklists
+                            if c in cols_checklists_pure]
+
+    all_meta_cols = (cols_complete + cols_ignore + cols_missing + cols_dag
+                     + cols_missing_explanation + cols_checklists)
+
+    result = {}
+    if len(cols_dag) > 0:
+        result.update({'dag': row['redcap_data_access_group']})
+
+    non_nan_count = row.drop(all_meta_cols).notnull().sum()
+    result.update({'non_nan_count': non_nan_count})
+
+    if cols_checklists_pure:
+        col_val1_count = (row[cols_checklists_pure].isin([1, '1'])).sum()
+        result.update({'non_nan_count': non_nan_count + col_val1_count})
+
+    if cols_ignore:
+        result.update({'exclude': row[cols_ignore].max(skipna=True)})
+    if cols_missing:
+        result.update({'missing': row[cols_missing].max(skipna=True)})
+    if len(cols_complete) > 0:
+        if 'np_reyo_qc___completed' in cols_complete:
+            result.update({'complete': row[cols_complete].max(skipna=True)})
+        else:
+            result.update({'complete': row[cols_complete[-1]]})
+
+    return pd.Series(result)
+
+
+def make_form_data(seed: int) -> pd.DataFrame:
+    """
+    Random records of a form, read back from CSV with inferred data types as
+    make_event_inventories does
+    """
+    rng = np.random.RandomState(seed)
+    n_records = rng.randint(1, 8)
+
+    def values(choices, nan_rate):
+        column = [str(rng.choice(choices)) for _ in range(n_records)]
+        return ['' if rng.rand() < nan_rate else value for value in column]
+
+    def nan_rate():
+        return rng.choice([0, 0, 0.3, 1])
+
+    columns = {
+        'study_id': ['NCANDA_S%05d' % i for i in range(n_records)],
+        'redcap_event_name': ['baseline_visit_arm_1'] * n_records,
+    }
+    if rng.rand() < 0.5:
+        columns['redcap_data_access_group'] = values(['sri', 'duke', 'ucsd'],
+                                                     nan_rate())
+    if rng.rand() < 0.8:
+        columns['visit_ignore___yes'] = values([0, 1], nan_rate())
+    if rng.rand() < 0.5:
+        columns['form_exclude'] = values([0, 1], nan_rate())
+    if rng.rand() < 0.7:
+        columns['form_missing'] = values([0, 1], nan_rate())
+    if rng.rand() < 0.5:
+        columns['form_missing_why'] = values(['lost', 'refused'], nan_rate())
+    if rng.rand() < 0.3:
+        columns['bio_mr_same_as_np___yes'] = values([0, 1], nan_rate())
+    for i in range(rng.randint(0, 3)):
+        columns['form_int_%d' % i] = values(range(-5, 40), nan_rate())
+    for i in range(rng.randint(0, 3)):
+        columns['form_float_%d' % i] = values([0.5, 1.25, 3.0, 12.75],
+                                              nan_rate())
+    for i in range(rng.randint(0, 2)):
+        columns['form_text_%d' % i] = values(['yes', 'no', 'n/a'], nan_rate())
+    for i in range(rng.randint(0, 3)):
+        columns['form_check___%d' % (i + 1)] = values([0, 1], nan_rate())
+    if rng.rand() < 0.2:
+        columns['np_reyo_qc___completed'] = values([0, 1], nan_rate())
+    if rng.rand() < 0.9:
+        columns['form_complete'] = values([0, 1, 2], nan_rate())
+
+    csv = pd.DataFrame(columns).to_csv(index=False)
+    return pd.read_csv(io.StringIO(csv),
+                       index_col=['study_id', 'redcap_event_name'],
+                       low_memory=False)
+
+
+@pytest.mark.parametrize("seed", range(300))
+def test_get_form_stats_matches_row_wise(seed):
+    form_data = make_form_data(seed)
+
+    expected = form_data.apply(get_flag_and_meta, axis=1)
+    result = get_form_stats(form_data)
+
+    pd.testing.assert_frame_equal(result, expected)
+    assert result.to_csv() == expected.to_csv()
+    assert (result.to_csv(float_format="%.0f")
+            == expected.to_csv(float_format="%.0f"))
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+##
+##  See COPYING file distributed along with the ncanda-data-integration package
+##  for the copyright and license terms
+##
+
+import ast
+import math
+import os
+import numpy as np
+import pandas
+import pytest
+
+SCRIPT = os.path.join(os.path.dirname(__file__), '../../../scripts/redcap/update_bulk_forms')
+
+
+# update_bulk_forms runs as soon as it is loaded, so only its status functions
+# are taken from it
+def load_status_functions():
+    with open(SCRIPT) as script:
+        tree = ast.parse(script.read())
+    tree.body = [node for node in tree.body
+                 if isinstance(node, ast.FunctionDef) and node.name.startswith('compute_')]
+    functions = {'pandas': pandas, 'math': math}
+    exec(compile(tree, SCRIPT, 'exec'), functions)
+    return functions
+
+
+bulk_forms = load_status_functions()
+
+
+#
+# Former row-by-row computations, applied per event with records.apply(..., axis=1)
+#
+def compute_clinical_complete_status(row, field_names, form_complete_field):
+    status=""
+    for field in field_names:
+        if not math.isnan(float(row[field])) :
+            if status == "" :
+               status = row[field]
+            elif  row[field] < status:
+                status = row[field]
+
+    return status
+
+
+def compute_lssaga_youth_complete_status(row, field_names, form_complete_field,event):
+    event_year=float(event.split('y',1)[0])
+    age=float(row['age'])
+
+    if  math.isnan(age) or age >= 23 or event_year < 4 :
+        return compute_bulk_status(row, field_names, form_complete_field)
+
+    return row['limesurvey_ssaga_part_1_youth_complete']
+
+
+def compute_bulk_status(row, field_names, form_complete_field):
+    status = None
+    for field in field_names:
+        if math.isnan(float(row[field])):
+            status = "0"
+            break
+        elif status == None or row[field] < status:
+            status = row[field]
+
+    return status
+
+
+# Random records as exported with dtype "object": status values are strings,
+# blank values NaN
+def make_records(seed, field_names, events):
+    rng = np.random.RandomState(seed)
+    n_subjects = rng.randint(1, 6)
+    index = pandas.MultiIndex.from_product(
+        [['NCANDA_S%05d' % i for i in range(n_subjects)], events],
+        names=['study_id', 'redcap_event_name'])
+
+    def values(choices):
+        nan_rate = rng.choice([0, 0.3, 1])
+        return [np.nan if rng.rand() < nan_rate else str(rng.choice(choices))
+                for _ in range(len(index))]
+
+    records = pandas.DataFrame({field: values(['0', '1', '2']) for field in field_names},
+                               index=index, dtype=object)
+    records['age'] = values(['12.5', '17', '22.9', '23', '25.1'])
+    return records
+
+
+def row_wise(records, function, *args):
+    by_event = []
+    for event in records.index.get_level_values('redcap_event_name').unique():
+        event_records = records[records.index.get_level_values('redcap_event_name') == event]
+        event_args = args + (event,) if function is compute_lssaga_youth_complete_status else args
+        by_event.append(event_records.apply(function, axis=1, args=event_args))
+    return pandas.concat(by_event).reindex(records.index)
+
+
+# Same values, including the type (str or float) and NaN
+def as_comparable(status):
+    return [(type(value), None if pandas.isna(value) else value) for value in status]
+
+
+@pytest.mark.parametrize("seed", range(200))
+def test_compute_bulk_status(seed):
+    field_names = ['form_part_%d_complete' % i for i in range(1 + seed % 4)]
+    records = make_records(seed, field_names, ['baseline_visit_arm_1', '1y_visit_arm_1'])
+
+    expected = row_wise(records, compute_bulk_status, field_names, 'form_complete')
+    result = bulk_forms['compute_bulk_status'](records, field_names, 'form_complete')
+    assert as_comparable(result) == as_comparable(expected)
+
+
+@pytest.mark.parametrize("seed", range(200))
+def test_compute_clinical_complete_status(seed):
+    field_names = ['clinical_part_%d_complete' % i for i in range(1 + seed % 4)]
+    records = make_records(seed, field_names, ['baseline_visit_arm_1', '2y_visit_arm_1'])
+
+    expected = row_wise(records, compute_clinical_complete_status, field_names, 'clinical_complete')
+    result = bulk_forms['compute_clinical_complete_status'](records, field_names, 'clinical_complete')
+    assert as_comparable(result) == as_comparable(expected)
+
+
+@pytest.mark.parametrize("seed", range(200))
+def test_compute_lssaga_youth_complete_status(seed):
+    field_names = ['limesurvey_ssaga_part_%d_youth_complete' % i for i in range(1, 2 + seed % 4)]
+    # baseline does not have lssaga
+    records = make_records(seed, field_names,
+                           ['1y_visit_arm_1', '3y_visit_arm_1', '4y_visit_arm_1', '6y_visit_arm_1'])
+
+    expected = row_wise(records, compute_lssaga_youth_complete_status,
+                        field_names, 'limesurvey_ssaga_youth_complete')
+    result = bulk_forms['compute_lssaga_youth_complete_status'](
+        records, field_names, 'limesurvey_ssaga_youth_complete')
+    assert as_comparable(result) == as_comparable(expected)
@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+
+##
+##  See COPYING file distributed along with the ncanda-data-integration package
+##  for the copyright and license terms
+##
+
+import os
+import sys
+import pytest
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../../scripts/xnat/'))
+from phantom_index import PhantomIndex
+
+
+@pytest.fixture
+def phantom_index():
+    return PhantomIndex([
+        ("E3", "S1", "scanner_a", "2020-01-10", "09:00:00"),
+        ("E1", "S1", "scanner_a", "2020-01-03", "12:00:00"),
+        ("E2", "S1", "scanner_a", "2020-01-03", "08:00:00"),
+        ("E4", "S2", "scanner_b", "2020-01-03", None),
+        ("E5", "S1", "scanner_a", "", None),
+    ])
+
+
+def test_sessions_on_date(phantom_index):
+    assert phantom_index.sessions_on_date("2020-01-03", scanner="scanner_a") == [("E2", "scanner_a"), ("E1", "scanner_a")]
+    assert phantom_index.sessions_on_date("2020-01-03", subject_id="S2") == [("E4", "scanner_b")]
+    assert phantom_index.sessions_on_date("2020-01-04", scanner="scanner_a") == []
+    assert phantom_index.sessions_on_date("2020-01-03", scanner="unknown") == []
+
+
+def test_sessions_within(phantom_index):
+    # Limits are inclusive and include the time of day
+    assert phantom_index.sessions_within("2020-01-10", "12:00:00", 7, subject_id="S1") == [("E3", "scanner_a"), ("E1", "scanner_a")]
+    assert phantom_index.sessions_within("2020-01-10", "12:00:01", 7, subject_id="S1") == [("E3", "scanner_a")]
+    assert phantom_index.nearest("2020-01-04", "09:00:00", 1, scanner="scanner_a") == "E1"
+    assert phantom_index.nearest("2020-01-20", None, 1, scanner="scanner_a") is None